@@ -98,6 +98,7 @@ class Agent(StateContext):
     @x.setter
     def x(self, value):
         self._location[0] = value
+        self._world.spatial.move(self, self._location)
 
     @property   # Returns agent's Y position in World
     def y(self):
@@ -106,6 +107,7 @@ class Agent(StateContext):
     @y.setter
     def y(self, value):
         self._location[1] = value
+        self._world.spatial.move(self, self._location)
 
     @property   # Returns agent's [X, Y] position in World
     def location(self):
@@ -115,6 +117,7 @@ class Agent(StateContext):
     def location(self, location):
         x, y = location
         self._location = [x, y]
+        self._world.spatial.move(self, self._location)
 
     @property
     def is_walking(self) -> bool:
@@ -159,8 +162,11 @@ class GotoState(State):
         else:
             context.revert_state()
 
-        arrive_msg = Telegram(context.agent_id, None, MessageTypes.MSG_ARRIVAL, context.location)
-        context.world.dispatch(arrive_msg)
+        # Announce the arrival only to agents already at the same place
+        present = tuple(agent.agent_id for agent in context.world.get_agents_at(context.location) if agent is not context)
+        if len(present) > 0:
+            arrive_msg = Telegram(context.agent_id, present, MessageTypes.MSG_ARRIVAL, context.location)
+            context.world.dispatch(arrive_msg)
 
     def _abort(self, context):
         """Call if agent failed pathing, to revert states appropriately"""
@@ -3,7 +3,8 @@
 from nnet import TrainingData
 
 WORLD_PATH = R"C:\Users\efiilj-7-local\Documents\Source\S0006D_ai\ai_fsm_lab1\map\Map1.txt"
-PATH_MODE = 2
+PATH_MODE = 2   # 0: depth first, 1: breadth first, 2: A*, 3: contraction hierarchy
+PATH_REUSE = True   # reuse routes between the same cells while the grid along them is unchanged
 TRAIN_NET = False
 NET_DATA = TrainingData(epochs=1000, set_size=2048, test_batch=100)
 EVAL_MODE = True
@@ -21,9 +21,9 @@ def draw_world():
             pos = pygame.mouse.get_pos()
             cell = (pos[0] // CELL_SIZE, pos[1] // CELL_SIZE)
             if WORLD.graph.is_free(cell):
-                WORLD.graph.walls.append(cell)
+                WORLD.graph.add_wall(cell)
             else:
-                WORLD.graph.walls.remove(cell)
+                WORLD.graph.remove_wall(cell)
 
 
     for y in range(WORLD.height):
@@ -94,5 +94,6 @@ if __name__ == "__main__":
 
         per_query = WORLD.path_time / WORLD.path_queries
         print("Pathfinding took {:.4} seconds over {} queries (~{:.4} s/q)".format(WORLD.path_time, WORLD.path_queries, per_query))
+        print("Reused {} routes".format(WORLD.routes.hits))
 
 # ============== FUNCTIONS ================
@@ -1,6 +1,7 @@
 from __future__ import annotations
 import collections
 import heapq
+import threading
 from enum import Enum, auto
 
 class QStack:
@@ -61,6 +62,25 @@ class Grid:
         self.width = width
         self.height = height
         self.walls = walls if walls is not None else []
+        self.version = 0
+        self.cell_versions = {}
+
+    def touch(self, cell):
+        """Marks a cell as changed, bumping the grid version"""
+        self.version += 1
+        self.cell_versions[cell] = self.version
+
+    def cell_version(self, cell):
+        """Returns the grid version at which a cell last changed"""
+        return self.cell_versions.get(cell, 0)
+
+    def add_wall(self, cell):
+        self.walls.append(cell)
+        self.touch(cell)
+
+    def remove_wall(self, cell):
+        self.walls.remove(cell)
+        self.touch(cell)
 
     def is_in_bounds(self, cell):
         (x, y) = cell
@@ -101,6 +121,78 @@ class WeightedGrid(Grid):
     def cost(self, cell):
         return self.weights.get(cell, self.default)
 
+class RouteCache:
+    """Remembers routes between pairs of cells, handing out a route (or its reverse)
+    again for as long as no cell it depends on has changed in the grid"""
+
+    def __init__(self, graph, capacity=256):
+        self.graph = graph
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._routes = collections.OrderedDict()   # (start, goal) -> (route, grid version)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._routes)
+
+    @staticmethod
+    def depends_on(route):
+        """Yields the cells that decide if a route can still be walked;
+        every cell entered, and the corners cut by each diagonal step"""
+
+        for a, b in zip(route, route[1:]):
+            yield b
+            if a[0] != b[0] and a[1] != b[1]:
+                yield b[0], a[1]
+                yield a[0], b[1]
+
+    def get(self, start, goal):
+        """Returns a copy of a valid cached route from start to goal, or None"""
+
+        start, goal = tuple(start), tuple(goal)
+
+        with self._lock:
+            key, reverse = (start, goal), False
+            entry = self._routes.get(key)
+
+            if entry is None:
+                key, reverse = (goal, start), True
+                entry = self._routes.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            route, version = entry
+
+            if version != self.graph.version:
+                if any(self.graph.cell_version(cell) > version for cell in RouteCache.depends_on(route)):
+                    del self._routes[key]
+                    self.misses += 1
+                    return None
+                self._routes[key] = (route, self.graph.version)
+
+            self._routes.move_to_end(key)
+            self.hits += 1
+            return list(reversed(route)) if reverse else list(route)
+
+    def put(self, route, version=None):
+        """Stores a route, found on the grid as it was at the specified version"""
+
+        if len(route) < 2:
+            return
+
+        version = self.graph.version if version is None else version
+
+        with self._lock:
+            key = (tuple(route[0]), tuple(route[-1]))
+            self._routes[key] = (tuple(route), version)
+            self._routes.move_to_end(key)
+
+            while len(self._routes) > self.capacity:
+                self._routes.popitem(last=False)
+
 class Path:
 
     class Algorithms(Enum):
@@ -186,3 +278,198 @@ class Path:
                     came_from[next_node] = node
 
         return False, [], cost_map[node]
+
+class ContractionHierarchy:
+    """Contraction hierarchy over the free cells of a weighted grid,
+    answering shortest path queries with a bidirectional upward search"""
+
+    witness_limit = 50
+
+    def __init__(self, graph):
+        self.version = graph.version
+        self.rank = {}
+        self.out_edges = {}
+        self.in_edges = {}
+
+        nodes = [(x, y) for y in range(graph.height) for x in range(graph.width) if graph.is_free((x, y))]
+
+        for node in nodes:
+            self.out_edges[node] = {}
+            self.in_edges[node] = {}
+
+        # moving to a cell costs the weight of that cell, so edges are directed
+        for node in nodes:
+            for next_node in graph.neighbours(node):
+                cost = graph.cost(next_node)
+                self.out_edges[node][next_node] = (cost, None)
+                self.in_edges[next_node][node] = (cost, None)
+
+        self._contract(nodes)
+
+    @classmethod
+    def build(cls, graph):
+        """Builds a hierarchy from a snapshot of the grid, safe to run in a separate thread"""
+        snapshot = WeightedGrid(graph.width, graph.height, list(graph.walls), dict(graph.weights), graph.default)
+        snapshot.version = graph.version
+        return cls(snapshot)
+
+    def _witness(self, source, skip, targets, limit):
+        """Bounded Dijkstra search from source, ignoring the skipped node and contracted nodes"""
+
+        cost_map = {source: 0}
+        edges = PriorityQueue()
+        edges.put(source, 0)
+        settled = 0
+
+        while not edges.is_empty and settled < self.witness_limit:
+            cost, node = heapq.heappop(edges.heap)
+
+            if cost > cost_map[node]:
+                continue
+            if cost > limit:
+                break
+
+            settled += 1
+            for next_node, (edge_cost, mid) in self.out_edges[node].items():
+                if next_node == skip or next_node in self.rank:
+                    continue
+                next_cost = cost + edge_cost
+                if next_node not in cost_map or next_cost < cost_map[next_node]:
+                    cost_map[next_node] = next_cost
+                    edges.put(next_node, next_cost)
+
+        return {target: cost_map[target] for target in targets if target in cost_map}
+
+    def _shortcuts(self, node):
+        """Returns the shortcuts needed to contract a node, as (from, to, cost)"""
+
+        sources = [(u, c) for u, (c, mid) in self.in_edges[node].items() if u not in self.rank]
+        targets = [(w, c) for w, (c, mid) in self.out_edges[node].items() if w not in self.rank]
+        shortcuts = []
+
+        if len(targets) == 0:
+            return shortcuts
+
+        max_out = max(c for w, c in targets)
+
+        for u, in_cost in sources:
+            found = self._witness(u, node, [w for w, c in targets], in_cost + max_out)
+            for w, out_cost in targets:
+                if w == u:
+                    continue
+                cost = in_cost + out_cost
+                if found.get(w, cost + 1) > cost:
+                    shortcuts.append((u, w, cost))
+
+        return shortcuts
+
+    def _priority(self, node, deleted):
+        degree = sum(1 for n in self.in_edges[node] if n not in self.rank)
+        degree += sum(1 for n in self.out_edges[node] if n not in self.rank)
+        return len(self._shortcuts(node)) - degree + deleted.get(node, 0)
+
+    def _contract(self, nodes):
+        """Contracts all nodes in order of edge difference, using lazy priority updates"""
+
+        deleted = {}
+        queue = PriorityQueue()
+        for node in nodes:
+            queue.put(node, self._priority(node, deleted))
+
+        while not queue.is_empty:
+            priority, node = heapq.heappop(queue.heap)
+
+            current = self._priority(node, deleted)
+            if not queue.is_empty and current > queue.heap[0][0]:
+                queue.put(node, current)
+                continue
+
+            for u, w, cost in self._shortcuts(node):
+                if w not in self.out_edges[u] or cost < self.out_edges[u][w][0]:
+                    self.out_edges[u][w] = (cost, node)
+                    self.in_edges[w][u] = (cost, node)
+
+            self.rank[node] = len(self.rank)
+
+            for neighbour in list(self.in_edges[node]) + list(self.out_edges[node]):
+                if neighbour not in self.rank:
+                    deleted[neighbour] = deleted.get(neighbour, 0) + 1
+
+    def _unpack(self, start, end, path):
+        """Appends the original nodes of an edge, excluding its start, to path"""
+
+        mid = self.out_edges[start][end][1]
+        if mid is None:
+            path.append(end)
+        else:
+            self._unpack(start, mid, path)
+            self._unpack(mid, end, path)
+
+    def search(self, start, goal):
+        """Returns the shortest path between two cells as (success, path)"""
+
+        if start not in self.rank or goal not in self.rank:
+            return False, []
+
+        if start == goal:
+            return True, [goal]
+
+        costs = ({start: 0}, {goal: 0})
+        parents = ({start: None}, {goal: None})
+        edge_maps = (self.out_edges, self.in_edges)
+        queues = (PriorityQueue(), PriorityQueue())
+        queues[0].put(start, 0)
+        queues[1].put(goal, 0)
+
+        best = None
+        best_cost = float("inf")
+
+        while not (queues[0].is_empty and queues[1].is_empty):
+            for side in (0, 1):
+                queue = queues[side]
+                if queue.is_empty:
+                    continue
+
+                cost, node = heapq.heappop(queue.heap)
+                if cost > costs[side][node]:
+                    continue
+                if cost >= best_cost:
+                    queue.heap.clear()
+                    continue
+
+                other = costs[1 - side]
+                if node in other and cost + other[node] < best_cost:
+                    best, best_cost = node, cost + other[node]
+
+                for next_node, (edge_cost, mid) in edge_maps[side][node].items():
+                    if self.rank[next_node] < self.rank[node]:
+                        continue
+                    next_cost = cost + edge_cost
+                    if next_node not in costs[side] or next_cost < costs[side][next_node]:
+                        costs[side][next_node] = next_cost
+                        parents[side][next_node] = node
+                        queue.put(next_node, next_cost)
+
+        if best is None:
+            return False, []
+
+        up = []
+        node = best
+        while node is not None:
+            up.append(node)
+            node = parents[0][node]
+        up.reverse()
+
+        down = []
+        node = best
+        while node is not None:
+            down.append(node)
+            node = parents[1][node]
+
+        path = [start]
+        for a, b in zip(up, up[1:]):
+            self._unpack(a, b, path)
+        for a, b in zip(down, down[1:]):
+            self._unpack(a, b, path)
+
+        return True, path
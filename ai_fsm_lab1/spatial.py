@@ -0,0 +1,78 @@
+""" Spatial indices for locating things in the world """
+
+from collections import defaultdict
+
+class SpatialHash:
+    """Uniform grid of buckets, hashing objects by position
+    for same-cell and radius queries"""
+
+    def __init__(self, bucket_size=8):
+        self.bucket_size = bucket_size
+        self._buckets = defaultdict(dict)
+        self._positions = {}
+
+    def __contains__(self, obj):
+        return obj in self._positions
+
+    def __len__(self):
+        return len(self._positions)
+
+    def _bucket(self, position):
+        """Internal - get the bucket key of a position"""
+        return int(position[0]) // self.bucket_size, int(position[1]) // self.bucket_size
+
+    def move(self, obj, position):
+        """Inserts an object at a position, or moves it there if already present"""
+
+        position = tuple(position)
+        bucket = self._bucket(position)
+        previous = self._positions.get(obj)
+
+        if previous is not None:
+            previous_bucket = self._bucket(previous)
+            if previous_bucket != bucket:
+                self._remove_from_bucket(obj, previous_bucket)
+
+        self._positions[obj] = position
+        self._buckets[bucket][obj] = position
+
+    def remove(self, obj):
+        """Removes an object from the hash"""
+
+        position = self._positions.pop(obj, None)
+        if position is not None:
+            self._remove_from_bucket(obj, self._bucket(position))
+
+    def _remove_from_bucket(self, obj, bucket):
+        """Internal - remove an object from a bucket, dropping the bucket if empty"""
+
+        contents = self._buckets[bucket]
+        contents.pop(obj, None)
+        if len(contents) == 0:
+            self._buckets.pop(bucket)
+
+    def at(self, position) -> list:
+        """Returns all objects at exactly the specified position"""
+
+        position = tuple(position)
+        contents = self._buckets.get(self._bucket(position), {})
+        return [obj for obj, pos in contents.items() if pos == position]
+
+    def near(self, position, radius) -> list:
+        """Returns all objects within a square of the specified radius around a position"""
+
+        x, y = position
+        min_x, min_y = self._bucket((x - radius, y - radius))
+        max_x, max_y = self._bucket((x + radius, y + radius))
+        found = []
+
+        for b_y in range(min_y, max_y + 1):
+            for b_x in range(min_x, max_x + 1):
+                contents = self._buckets.get((b_x, b_y))
+                if contents is None:
+                    continue
+                for obj, pos in contents.items():
+                    if abs(pos[0] - x) <= radius and abs(pos[1] - y) <= radius:
+                        found.append(obj)
+
+        return found
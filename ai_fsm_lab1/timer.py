@@ -0,0 +1,59 @@
+""" Provides a timer queue for scheduling delayed events """
+
+import heapq
+import itertools
+
+class TimerHandle:
+    """A handle to a scheduled timer, which can be used to cancel it"""
+
+    __slots__ = ("time", "item", "cancelled")
+
+    def __init__(self, time, item):
+        self.time = time
+        self.item = item
+        self.cancelled = False
+
+    def cancel(self):
+        """Cancels the timer, if it has not already fired"""
+        self.cancelled = True
+
+class TimerQueue:
+    """A binary heap of timers keyed on due time,
+    with O(log n) insertion and removal, and lazy cancellation"""
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    @property
+    def is_empty(self):
+        return len(self._heap) == 0
+
+    @property
+    def next_time(self):
+        """Returns the due time of the earliest timer, or None if the queue is empty"""
+        return self._heap[0][0] if self._heap else None
+
+    def schedule(self, time, item) -> TimerHandle:
+        """Schedules an item to be due at the specified time, returning a cancellable handle"""
+
+        handle = TimerHandle(time, item)
+        heapq.heappush(self._heap, (time, next(self._counter), handle))
+        return handle
+
+    def pop_due(self, time):
+        """Removes and returns all items due at or before the specified time,
+        in order of due time, skipping cancelled timers"""
+
+        due = []
+        heap = self._heap
+
+        while heap and heap[0][0] <= time:
+            handle = heapq.heappop(heap)[2]
+            if not handle.cancelled:
+                due.append(handle.item)
+
+        return due
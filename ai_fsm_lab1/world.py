@@ -1,11 +1,14 @@
 """ Represent a 2D world with agents and locations """
 
+import threading
 import timeit
 from random import randint
 from telegram import Telegram
-from path import WeightedGrid, Path
+from timer import TimerQueue
+from path import WeightedGrid, Path, ContractionHierarchy, RouteCache
+from spatial import SpatialHash
 
-from config import EVAL_MODE, PATH_MODE
+from config import EVAL_MODE, PATH_MODE, PATH_REUSE
 
 def load_map(filename):
     try:
@@ -44,14 +47,21 @@ class World:
     _next_id = 0        # Static ID counter
 
     def __init__(self, width, height, walls=None, locations=None, heuristic=Path.diagonal):
-        self._messages = []
+        self._timers = TimerQueue()
         self._time = 0
         self._graph = WeightedGrid(width, height, walls)
         self._perf_path_time = 0
         self._perf_path_queries = 0
+        self.routes = RouteCache(self._graph)
         self.agents = {}
+        self.spatial = SpatialHash()
         self.locations = locations if locations is not None else {}
         self.heuristic = heuristic
+        self._hierarchy = None
+        self._hierarchy_thread = None
+
+        if PATH_MODE == 3:
+            self._hierarchy = ContractionHierarchy.build(self._graph)
 
     @classmethod
     def from_map(cls, filename, locations=None):
@@ -97,6 +107,19 @@ class World:
     def graph(self) -> WeightedGrid:
         return self._graph
 
+    # Returns the contraction hierarchy if it is up to date with the grid,
+    # otherwise starts rebuilding it in the background and returns None
+    @property
+    def hierarchy(self):
+        if self._hierarchy is not None and self._hierarchy.version == self.graph.version:
+            return self._hierarchy
+
+        if self._hierarchy_thread is None or not self._hierarchy_thread.is_alive():
+            self._hierarchy_thread = threading.Thread(target=self._rebuild_hierarchy, daemon=True)
+            self._hierarchy_thread.start()
+
+        return None
+
     @property
     def path_time(self):
         return self._perf_path_time
@@ -120,12 +143,14 @@ class World:
     def _cell_is_free(self, cell) -> bool:
         return cell not in self.locations.values() and self.graph.is_free(cell)
 
+    # Internal - build a new contraction hierarchy, run in a separate thread
+    def _rebuild_hierarchy(self):
+        self._hierarchy = ContractionHierarchy.build(self.graph)
+
     # Internal - dispatch all due messages in queue
     def _dispatch_delayed(self):
-        for message in self._messages:
-            if self._time >= message.dispatch_time:
-                self.dispatch(message)
-                self._messages.remove(message)
+        for message in self._timers.pop_due(self._time):
+            self.dispatch(message)
 
     # Register an agent and call initializer, returning agent's assigned ID
     def register_agent(self, agent) -> int:
@@ -136,7 +161,7 @@ class World:
 
     # Remove an agent from the dictionary
     def remove_agent(self, agent_id: int):
-        if agent_id in self.agents: self.agents.pop(agent_id)
+        if agent_id in self.agents: self.spatial.remove(self.agents.pop(agent_id))
 
     # Returns an agent when provided with valid ID
     def get_agent(self, agent_id: int):
@@ -151,6 +176,14 @@ class World:
                 agents.append(agent)
         return agents
 
+    # Returns a list of all agents at exactly the specified position
+    def get_agents_at(self, position):
+        return self.spatial.at(position)
+
+    # Returns a list of all agents within a square radius around a position
+    def get_agents_near(self, position, radius):
+        return self.spatial.near(position, radius)
+
     # Returns a location coordinate when provided with location string
     def get_location(self, name: str) -> (int, int):
         return self.locations.get(name, (0, 0))
@@ -162,6 +195,12 @@ class World:
                 return cell
 
     def get_path(self, path_from, path_to):
+        # Trips between the same places, such as home and work, reuse their routes
+        if PATH_REUSE:
+            route = self.routes.get(path_from, path_to)
+            if route is not None:
+                return True, route
+
         if PATH_MODE == 0:
             start = timeit.default_timer()
             path = Path.brute_force_search(self.graph, path_from, path_to, False)
@@ -171,12 +210,23 @@ class World:
         elif PATH_MODE == 2:
             start = timeit.default_timer()
             path = Path.a_star_search(self.graph, path_from, path_to, self.heuristic)[:2]
+        elif PATH_MODE == 3:
+            start = timeit.default_timer()
+            hierarchy = self.hierarchy
+            if hierarchy is not None:
+                path = hierarchy.search(path_from, path_to)
+            else:   # Fall back on A* while the hierarchy is rebuilt
+                path = Path.a_star_search(self.graph, path_from, path_to, self.heuristic)[:2]
         else:
              return None
 
         end = timeit.default_timer()
         self._perf_path_time += (end - start)
         self._perf_path_queries += 1
+
+        if PATH_REUSE and path[0]:
+            self.routes.put(path[1])
+
         return path
 
 
@@ -234,15 +284,23 @@ class World:
                 agent.handle_message(telegram)
             return len(agents)
 
-        telegram.dispatch_time = self._time + delay
-        self._messages.append(telegram)
+        self.schedule(telegram, delay)
         return 0
 
-    # Set a message for scheduled dispatch, the current or next day
+    # Schedule a message for dispatch after a delay, returning a cancellable TimerHandle
+    def schedule(self, telegram: Telegram, delay):
+        telegram.dispatch_time = self._time + delay
+        return self._timers.schedule(telegram.dispatch_time, telegram)
+
+    # Set a message for scheduled dispatch, the current or next day, returning a cancellable TimerHandle if delayed
     def dispatch_scheduled(self, time, telegram: Telegram):
         if time < self.time:
             time += (24 - self.time)
         else:
             time -= self.time
 
-        self.dispatch(telegram, time)
\ No newline at end of file
+        if time <= 0:
+            self.dispatch(telegram)
+            return None
+
+        return self.schedule(telegram, time)
\ No newline at end of file
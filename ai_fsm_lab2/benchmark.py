@@ -0,0 +1,122 @@
+""" Benchmarks how the colony simulation scales with population, map size and time scale.
+Every run is made in a fresh process, so that peak memory is measured per run """
+
+import argparse
+import itertools
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+from contextlib import redirect_stdout
+
+from config import *
+
+
+def enlarge_map(lines, factor):
+    """Tiles the inside of a bordered map factor times in each direction,
+    mirroring every other tile so that terrain lines up at the seams,
+    and surrounds the result with a new border"""
+
+    inner = [line.rstrip("\n")[1:-1] for line in lines[1:-1]]
+    rows = []
+
+    for tile_y in range(factor):
+        tile = inner if tile_y % 2 == 0 else inner[::-1]
+        for line in tile:
+            row = "".join(line if tile_x % 2 == 0 else line[::-1] for tile_x in range(factor))
+            rows.append("B" + row + "B\n")
+
+    border = "B" * (len(rows[0]) - 1) + "\n"
+    return [border] + rows + [border]
+
+def run_single(units, map_scale, time_scale, ticks, seed):
+    """Runs one benchmark in this process, returning its counters"""
+
+    import headless
+    from world import World
+
+    random.seed(seed)
+
+    with open(WORLD_PATH, "r") as file:
+        lines = file.readlines()
+
+    world = World.from_lines(enlarge_map(lines, map_scale) if map_scale > 1 else lines)
+
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        stats = headless.run(ticks, time_scale / FPS, units, world=world)
+
+    stats.update({
+        "map_scale": map_scale,
+        "map_size": [world.width, world.height],
+        "time_scale": time_scale,
+        "seed": seed,
+        # kilobytes on Linux
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    })
+
+    return stats
+
+def run_sweep(unit_counts, map_scales, time_scales, ticks, seed, timeout=None):
+    """Runs every combination of the sweep parameters in a separate process,
+    returning a list of results"""
+
+    results = []
+
+    for units, map_scale, time_scale in itertools.product(unit_counts, map_scales, time_scales):
+        args = [sys.executable, os.path.abspath(__file__), "--single",
+                "-u", str(units), "-m", str(map_scale), "-s", str(time_scale),
+                "-t", str(ticks), "--seed", str(seed)]
+
+        print("units {}, map x{}, time scale {}... ".format(units, map_scale, time_scale), end="", flush=True, file=sys.stderr)
+
+        try:
+            proc = subprocess.run(args, capture_output=True, text=True, timeout=timeout, cwd=GAME_PATH)
+        except subprocess.TimeoutExpired:
+            print("timed out", file=sys.stderr)
+            results.append({"units": units, "map_scale": map_scale, "time_scale": time_scale, "error": "timeout"})
+            continue
+
+        if proc.returncode != 0:
+            print("failed", file=sys.stderr)
+            error = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "exit code {}".format(proc.returncode)
+            results.append({"units": units, "map_scale": map_scale, "time_scale": time_scale, "error": error})
+            continue
+
+        stats = json.loads(proc.stdout)
+        print("{:.0f} ticks/s".format(stats["ticks_per_sec"]), file=sys.stderr)
+        results.append(stats)
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the colony simulation, writing results as JSON")
+    parser.add_argument("-u", "--units", type=int, nargs="+", default=[50, 200, 1000, 5000, 10000], help="unit counts to sweep")
+    parser.add_argument("-m", "--map-scale", type=int, nargs="+", default=[1, 2, 4], help="map enlargement factors to sweep")
+    parser.add_argument("-s", "--time-scale", type=float, nargs="+", default=[1, 2, 4], help="time scales to sweep")
+    parser.add_argument("-t", "--ticks", type=int, default=2000, help="number of world steps per run")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the random generator")
+    parser.add_argument("--timeout", type=float, default=None, help="seconds before a run is abandoned")
+    parser.add_argument("-o", "--output", default=None, help="file to write results to, instead of stdout")
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        stats = run_single(args.units[0], args.map_scale[0], args.time_scale[0], args.ticks, args.seed)
+        json.dump(stats, sys.stdout)
+        sys.stdout.flush()
+        # skip interpreter teardown, the path thread may still be busy
+        os._exit(0)
+
+    results = run_sweep(args.units, args.map_scale, args.time_scale, args.ticks, args.seed, args.timeout)
+    output = json.dumps({"ticks": args.ticks, "seed": args.seed, "runs": results}, indent=2)
+
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w") as file:
+            file.write(output)
+
+if __name__ == '__main__':
+    main()
@@ -14,8 +14,14 @@ WORLD_ORE_COUNT = 50
 HAS_FOG = True
 
 TILE_SIZE = 16
+SPATIAL_BUCKET_SIZE = 8
 
 FPS = 60
+SIM_STEP = TIME_SCALE / FPS
+SIM_MAX_CATCH_UP = 5
+SIM_SPEEDS = (1, 2, 4, 8, 16, 32, 64)
+HEADLESS_TICKS = 20000
+SHARD_ID_STRIDE = 1 << 20
 WINDOW_CAPTION = "Blorf 3.0"
 WINDOW_WIDTH = 750
 WINDOW_HEIGHT = 750
@@ -46,6 +52,8 @@ INIT_SCOUT = 5
 INIT_LOGGER = 10
 
 TARGET_KILN = 3
+TARGET_FETCHERS = 3
+JOB_MATCH_MAX_COST = 150
 
 UNIT_SPEED = 1
 UNIT_SPEED_SCOUT = 2
@@ -64,6 +72,21 @@ TIME_TRAIN_KILNER = 120
 TIME_CHOP_TREE = 30
 TIME_PRODUCE_COAL = 20
 
+THINK_INTERVAL_MANAGER = 10
+THINK_INTERVAL_SCOUT = 4
+
 MAX_DIJKSTRA_SCOUT_DIST = 30
 MAX_PATH_WAIT_RANDOM = 30
 MAX_PATH_FAIL_TIME = 10
+
+PATH_STREAM_MIN_DIST = 20
+PATH_STREAM_PREFIX = 8
+PATH_STREAM_BUDGET = 64
+PATH_SCOUT_BUDGET = 400
+PATH_RESOURCE_CANDIDATES = 5
+PATH_ANYTIME_LOAD = 8
+PATH_ANYTIME_MULT = 2.5
+PATH_ANYTIME_STEP = 0.5
+PATH_ANYTIME_TIME = 0.005
+PATH_LATENCY_SAMPLES = 10000
+PATH_ROUTE_CACHE = 1024
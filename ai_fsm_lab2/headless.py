@@ -0,0 +1,100 @@
+""" Runs the colony simulation without graphics, stepping the world
+as fast as possible and reporting throughput and economy counters """
+
+import argparse
+import os
+import random
+import timeit
+from contextlib import redirect_stdout
+
+import numpy as np
+
+from config import *
+from unit import spawn_colony
+from world import BuildingTypes, ResourceTypes, World
+
+
+def run(ticks=HEADLESS_TICKS, step=SIM_STEP, units=INIT_UNITS, world_path=WORLD_PATH, seed=None, world=None, sync_paths=True, regions=1):
+    """Simulates a new colony for a number of fixed steps, in a world loaded
+    from a map unless one is provided, returning a dict of throughput and economy counters.
+    With sync_paths, every step waits for its path queries to be answered, so that
+    results do not depend on how much time the path thread gets between steps.
+    With more than one region, the map is split between worker processes,
+    each running a colony of its own share of the units"""
+
+    if regions > 1:
+        import shard
+        with open(world_path, "r") as file:
+            lines = file.readlines()
+        return shard.run(ticks, step, units, lines, regions, seed, sync_paths)
+
+    if seed is not None:
+        random.seed(seed)
+
+    if world is None:
+        world = World.from_map(world_path)
+
+    spawn_cell, _ = spawn_colony(world, units)
+    world.reveal(spawn_cell)
+    sent = world.messages_sent
+
+    start = timeit.default_timer()
+    for _ in range(ticks):
+        world.step_forward(step)
+        if sync_paths:
+            world.wait_for_paths()
+    elapsed = timeit.default_timer() - start
+
+    latency = np.array(world.path_latency) * 1000
+    percentiles = np.percentile(latency, (50, 90, 99)).tolist() if len(latency) > 0 else [None] * 3
+
+    return {
+        "ticks": ticks,
+        "seconds": elapsed,
+        "ticks_per_sec": ticks / elapsed if elapsed > 0 else float("inf"),
+        "sim_time": world.time,
+        "messages_per_tick": (world.messages_sent - sent) / ticks,
+        "path_queries": len(latency),
+        "path_latency_ms": dict(zip(("p50", "p90", "p99"), percentiles)),
+        "units": len(world.agents),
+        "active": world.active_count,
+        "resources": {res.name: world.get_resource_total(res) for res in ResourceTypes},
+        "buildings": {building.name: world.buildings.count(building) for building in BuildingTypes},
+        "states": {state.__name__: count for state, count in world.units.state_counts().items()},
+    }
+
+def report(stats):
+    """Prints the counters returned by run"""
+
+    print("{ticks} ticks in {seconds:.2f} s ({ticks_per_sec:.0f} ticks/s), {sim_time:.0f} s simulated".format(**stats))
+    print("Units: {units} ({active} awake)".format(**stats))
+    if "regions" in stats:
+        print("Regions: {regions} ({migrations} migrations)".format(**stats))
+    print("Messages: {:.3f} per tick".format(stats["messages_per_tick"]))
+    if stats["path_queries"] > 0:
+        print("Path latency: {p50:.1f} ms p50, {p90:.1f} ms p90, {p99:.1f} ms p99".format(**stats["path_latency_ms"]))
+    for key in ("resources", "buildings", "states"):
+        print("{}: {}".format(key.capitalize(), ", ".join("{} {}".format(k, v) for k, v in sorted(stats[key].items()))))
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the colony simulation without graphics")
+    parser.add_argument("-t", "--ticks", type=int, default=HEADLESS_TICKS, help="number of world steps to simulate")
+    parser.add_argument("-s", "--step", type=float, default=SIM_STEP, help="simulated seconds per step")
+    parser.add_argument("-u", "--units", type=int, default=INIT_UNITS, help="number of units to spawn")
+    parser.add_argument("-m", "--map", default=WORLD_PATH, help="path to the map file")
+    parser.add_argument("--seed", type=int, default=None, help="seed for the random generator")
+    parser.add_argument("--async-paths", action="store_true", help="let path queries finish in the background")
+    parser.add_argument("-r", "--regions", type=int, default=1, help="number of worker processes to split the map between")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show unit chatter")
+    args = parser.parse_args()
+
+    if args.verbose:
+        stats = run(args.ticks, args.step, args.units, args.map, args.seed, sync_paths=not args.async_paths, regions=args.regions)
+    else:
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            stats = run(args.ticks, args.step, args.units, args.map, args.seed, sync_paths=not args.async_paths, regions=args.regions)
+
+    report(stats)
+
+if __name__ == '__main__':
+    main()
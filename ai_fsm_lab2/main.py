@@ -1,13 +1,12 @@
 import sys
 from os import path
-from random import choice
 
 import pygame as pg
 
 from camera import Camera
 from config import *
 from sprites import *
-from unit import Manager, Unit, Worker
+from unit import spawn_colony
 from world import TerrainTypes, ResourceTypes, BuildingTypes, World
 
 
@@ -32,6 +31,8 @@ class Game:
         self.camera = None
         self.playing = False
         self.dt = 0
+        self.sim_speed = 1
+        self.accumulator = 0
 
         self.load_data()
 
@@ -40,22 +41,10 @@ class Game:
         self.background = pg.image.load(BACKGROUND_PATH)
 
     def spawn(self):
-        while True:
-            spawn_cell = self.world.get_random_cell()
-            spawn_region = self.world.graph.neighbours(spawn_cell, False)
-            spawn_region.append(spawn_cell)
-            if all(self.world.graph.is_free(elem) for elem in spawn_region):
-                break
-
-        for u in range(INIT_UNITS - 1):
-            rand_cell = choice(spawn_region)
-            unit = Unit(self.world, rand_cell, Worker)
-            UnitSprite(self, unit)
-            unit.start()
+        spawn_cell, units = spawn_colony(self.world, INIT_UNITS)
 
-        manager = Unit(self.world, spawn_cell, Manager)
-        manager.start()
-        UnitSprite(self, manager)
+        for unit in units:
+            UnitSprite(self, unit)
 
         return spawn_cell
 
@@ -80,7 +69,8 @@ class Game:
             elif cell[0] is TerrainTypes.Tree:
                 Tree(self, x, y)
 
-        self.world.on_buildings_changed.append(self.on_building)
+        self.world.buildings.subscribe(self.on_building, BuildingTypes.Camp)
+        self.world.buildings.subscribe(self.on_building, BuildingTypes.Kiln)
         self.world.on_resources_changed.append(self.on_resource)
 
         self.spawn_cell = self.spawn()
@@ -103,7 +93,7 @@ class Game:
         self.playing = True
         while self.playing:
             self.dt = self.clock.tick(FPS) / 1000
-            pg.display.set_caption("{} - {} FPS".format(WINDOW_CAPTION, int(self.clock.get_fps())))
+            pg.display.set_caption("{} - {} FPS - {}x".format(WINDOW_CAPTION, int(self.clock.get_fps()), self.sim_speed))
             self.events()
             self.update()
             self.draw()
@@ -113,8 +103,20 @@ class Game:
         sys.exit()
 
     def update(self):
-        # update portion of the game loop
-        self.world.step_forward(self.dt * TIME_SCALE)
+        # update portion of the game loop, stepping the world in fixed steps
+        # and dropping time that would take more than the catch-up limit to simulate
+        self.accumulator += self.dt * TIME_SCALE * self.sim_speed
+        max_steps = SIM_MAX_CATCH_UP * self.sim_speed
+        steps = 0
+
+        while self.accumulator >= SIM_STEP and steps < max_steps:
+            self.world.step_forward(SIM_STEP)
+            self.accumulator -= SIM_STEP
+            steps += 1
+
+        if steps == max_steps:
+            self.accumulator = min(self.accumulator, SIM_STEP)
+
         self.all_sprites.update()
         self.camera.update(self.dt)
 
@@ -140,6 +142,9 @@ class Game:
             if event.type == pg.KEYDOWN:
                 if event.key == pg.K_ESCAPE:
                     self.quit()
+                # number keys select simulation speed, from 1x up to 64x
+                if pg.K_1 <= event.key < pg.K_1 + len(SIM_SPEEDS):
+                    self.sim_speed = SIM_SPEEDS[event.key - pg.K_1]
 
 # create the game object
 g = Game()
@@ -0,0 +1,186 @@
+""" Batched movement of walking units along their paths """
+
+import numpy as np
+
+
+class MovementSystem:
+    """Keeps the paths and progress of every walking unit in arrays,
+    advancing all of them in one vectorized pass per world step.
+    Speeds are read from, and positions written to, the unit store"""
+
+    def __init__(self, graph, units, spatial, capacity=16):
+        self._graph = graph
+        self._units = units
+        self._spatial = spatial
+        self._walkers = []      # (context, goto) per slot
+        self._slots = {}        # goto -> slot
+        self._paths = []        # path list per slot, as last seen
+        self._versions = []     # path version per slot, as last seen
+
+        self._progress = np.zeros(capacity)
+        self._length = np.zeros(capacity, dtype=np.intp)
+        self._unit = np.zeros(capacity, dtype=np.intp)
+        self._streaming = np.zeros(capacity, dtype=bool)
+        self._offset = np.zeros(capacity, dtype=np.intp)
+        self._cells = np.zeros(0, dtype=np.intp)
+        self._dirty = False
+
+        self._inv_cost = np.ones(graph.width * graph.height)
+        for i in range(len(self._inv_cost)):
+            self._set_cost(i % graph.width, i // graph.width)
+
+        graph.on_terrain_changed.append(self.on_terrain_changed)
+
+    def __len__(self):
+        return len(self._walkers)
+
+    def __contains__(self, goto):
+        return goto in self._slots
+
+    def _set_cost(self, x, y):
+        cost = self._graph.cost((x, y))
+        # cells that cannot be walked are crossed at ground speed rather than stalling the unit
+        self._inv_cost[x + self._graph.width * y] = 1 / cost if cost > 0 else 1
+
+    def on_terrain_changed(self, cell, terrain):
+        self._set_cost(*cell)
+
+    def _grow(self):
+        capacity = len(self._progress) * 2
+        for name in ("_progress", "_length", "_unit", "_streaming", "_offset"):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def add(self, context, goto):
+        """Starts moving a unit along the path of its Goto state,
+        or picks up a changed path if it is already moving"""
+
+        slot = self._slots.get(goto)
+
+        if slot is None:
+            slot = len(self._walkers)
+            if slot == len(self._progress):
+                self._grow()
+            self._walkers.append((context, goto))
+            self._paths.append(None)
+            self._versions.append(None)
+            self._slots[goto] = slot
+            self._progress[slot] = goto.progress
+
+        elif goto.path is not self._paths[slot]:
+            # a new path list restarts from the progress set by the state
+            self._progress[slot] = goto.progress
+
+        self._paths[slot] = goto.path
+        self._versions[slot] = goto.version
+        self._length[slot] = len(goto.path)
+        self._unit[slot] = context.slot
+        self._streaming[slot] = goto.streaming
+        self._dirty = True
+
+    def remove(self, goto):
+        """Stops moving the unit following a Goto state, writing back its progress"""
+
+        slot = self._slots.pop(goto, None)
+
+        if slot is None:
+            return
+
+        goto.progress = float(self._progress[slot])
+
+        last = len(self._walkers) - 1
+        if slot != last:
+            self._walkers[slot] = self._walkers[last]
+            self._paths[slot] = self._paths[last]
+            self._versions[slot] = self._versions[last]
+            for arr in (self._progress, self._length, self._unit, self._streaming):
+                arr[slot] = arr[last]
+            self._slots[self._walkers[slot][1]] = slot
+
+        self._walkers.pop()
+        self._paths.pop()
+        self._versions.pop()
+        self._dirty = True
+
+    def progress(self, goto) -> float:
+        """Returns the progress of a Goto state along its path"""
+
+        slot = self._slots.get(goto)
+        return goto.progress if slot is None else float(self._progress[slot])
+
+    def is_current(self, goto) -> bool:
+        """Checks if the path of a moving Goto state has been seen by the system"""
+
+        slot = self._slots.get(goto)
+        return slot is not None and self._versions[slot] == goto.version
+
+    def _rebuild(self):
+        """Flattens all paths into one buffer of cell indices"""
+
+        width = self._graph.width
+        count = len(self._walkers)
+        lengths = self._length[:count]
+
+        self._offset[:count] = np.cumsum(lengths) - lengths
+        # streamed paths may grow on the path thread, so only read the part seen by add
+        cells = (x + width * y for path, n in zip(self._paths, lengths.tolist()) for x, y in path[:n])
+        self._cells = np.fromiter(cells, dtype=np.intp, count=int(lengths.sum()))
+        self._dirty = False
+
+    def step(self, step):
+        """Advances every walking unit, moving them on the grid and
+        reporting arrivals back to their Goto states"""
+
+        count = len(self._walkers)
+
+        if count == 0:
+            return
+
+        if self._dirty:
+            self._rebuild()
+
+        progress = self._progress[:count]
+        length = self._length[:count]
+        streaming = self._streaming[:count]
+        offset = self._offset[:count]
+        unit = self._unit[:count]
+
+        start = progress.astype(np.intp)
+        substeps = np.ceil(self._units.speed[unit] * step).astype(np.intp)
+        moving = np.ones(count, dtype=bool)
+
+        for i in range(int(substeps.max())):
+
+            # wait at the end of a streamed prefix until the remainder arrives
+            moving &= (substeps > i) & ~(streaming & (progress >= length - 1))
+
+            if not moving.any():
+                break
+
+            index = np.minimum(progress.astype(np.intp), length - 1)
+            progress += np.where(moving, self._inv_cost[self._cells[offset + index]], 0)
+
+            np.minimum(progress, np.where(streaming, length - 1, np.inf), out=progress)
+            moving &= progress < length
+
+        arrived = (progress >= length).nonzero()[0]
+        index = np.minimum(progress.astype(np.intp), length - 1)
+        changed = (index != start).nonzero()[0]
+
+        # write new cells straight into the unit store, rehashing only units that moved
+        cells = self._cells[offset[changed] + index[changed]]
+        xs, ys = cells % self._graph.width, cells // self._graph.width
+        self._units.position[unit[changed], 0] = xs
+        self._units.position[unit[changed], 1] = ys
+
+        for slot, x, y in zip(changed.tolist(), xs.tolist(), ys.tolist()):
+            self._spatial.move(self._walkers[slot][0], (x, y))
+
+        finished = [self._walkers[slot] for slot in arrived.tolist()]
+
+        for context, goto in finished:
+            self.remove(goto)
+            context.location = goto.target
+            goto.on_finish(context)
@@ -1,6 +1,8 @@
 from __future__ import annotations
 import collections
 import heapq
+import threading
+import timeit
 from enum import Enum, auto
 
 class QStack:
@@ -61,6 +63,17 @@ class Grid:
         self.width = width
         self.height = height
         self.walls = walls if walls is not None else []
+        self.version = 0
+        self.cell_versions = {}
+
+    def touch(self, cell):
+        """Marks a cell as changed, bumping the grid version"""
+        self.version += 1
+        self.cell_versions[cell] = self.version
+
+    def cell_version(self, cell):
+        """Returns the grid version at which a cell last changed"""
+        return self.cell_versions.get(cell, 0)
 
     def is_in_bounds(self, cell):
         (x, y) = cell
@@ -108,6 +121,78 @@ class WeightedGrid(Grid):
     def cost(self, cell):
         return self.weights.get(cell, self.default)
 
+class RouteCache:
+    """Remembers routes between pairs of cells, handing out a route (or its reverse)
+    again for as long as no cell it depends on has changed in the grid"""
+
+    def __init__(self, graph, capacity=256):
+        self.graph = graph
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._routes = collections.OrderedDict()   # (start, goal) -> (route, grid version)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._routes)
+
+    @staticmethod
+    def depends_on(route):
+        """Yields the cells that decide if a route can still be walked;
+        every cell entered, and the corners cut by each diagonal step"""
+
+        for a, b in zip(route, route[1:]):
+            yield b
+            if a[0] != b[0] and a[1] != b[1]:
+                yield b[0], a[1]
+                yield a[0], b[1]
+
+    def get(self, start, goal):
+        """Returns a copy of a valid cached route from start to goal, or None"""
+
+        start, goal = tuple(start), tuple(goal)
+
+        with self._lock:
+            key, reverse = (start, goal), False
+            entry = self._routes.get(key)
+
+            if entry is None:
+                key, reverse = (goal, start), True
+                entry = self._routes.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            route, version = entry
+
+            if version != self.graph.version:
+                if any(self.graph.cell_version(cell) > version for cell in RouteCache.depends_on(route)):
+                    del self._routes[key]
+                    self.misses += 1
+                    return None
+                self._routes[key] = (route, self.graph.version)
+
+            self._routes.move_to_end(key)
+            self.hits += 1
+            return list(reversed(route)) if reverse else list(route)
+
+    def put(self, route, version=None):
+        """Stores a route, found on the grid as it was at the specified version"""
+
+        if len(route) < 2:
+            return
+
+        version = self.graph.version if version is None else version
+
+        with self._lock:
+            key = (tuple(route[0]), tuple(route[-1]))
+            self._routes[key] = (tuple(route), version)
+            self._routes.move_to_end(key)
+
+            while len(self._routes) > self.capacity:
+                self._routes.popitem(last=False)
+
 class Path:
 
     class Algorithms(Enum):
@@ -202,6 +287,216 @@ class Path:
         success, path = Path.a_star_search(graph, start, goal, cost_mult, heuristic, filter_func)
         on_finish(success, path)
 
+    @staticmethod
+    def a_star_multi(graph, start, goals, cost_mult=1, heuristic=None, filter_func=None):
+        """Performs an A* search towards the nearest of several goals,
+        using the minimum heuristic over the goal set"""
+
+        goals = set(goals)
+        cost_map = {start: 0}
+        came_from = {start: None}
+
+        if start in goals:
+            return True, [start]
+
+        edges = PriorityQueue()
+        edges.put(start, 0)
+
+        while not edges.is_empty:
+            node = edges.pop()
+
+            if node in goals:
+                return True, Path.reconstruct(came_from, start, node)
+
+            for next_node in graph.neighbours(node, True, filter_func):
+                next_cost = cost_map[node] + graph.cost(next_node)
+                if next_node not in cost_map or next_cost < cost_map[next_node]:
+                    cost_map[next_node] = next_cost
+                    priority = next_cost
+
+                    if heuristic is not None:
+                        priority += cost_mult * min(heuristic(next_node, goal) for goal in goals)
+
+                    edges.put(next_node, priority)
+                    came_from[next_node] = node
+
+        return False, []
+
+    @staticmethod
+    def a_star_multi_proxy(graph, start, goals, on_finish, cost_mult=1, heuristic=None, filter_func=None):
+        success, path = Path.a_star_multi(graph, start, goals, cost_mult, heuristic, filter_func)
+        on_finish(success, path)
+
+    @staticmethod
+    def a_star_partial(graph, start, goal, budget=None, deadline=None, cost_mult=1, heuristic=None, filter_func=None):
+        """Performs an A* search limited by an expansion budget and/or a deadline
+        (as a timeit.default_timer timestamp). If the goal is not reached, the path
+        to the expanded node with the lowest heuristic is returned, flagged as partial"""
+
+        cost_map = {start: 0}
+        came_from = {start: None}
+
+        if start == goal:
+            return True, [goal], False
+
+        best = start
+        best_h = heuristic(start, goal)
+
+        edges = PriorityQueue()
+        edges.put(start, 0)
+
+        while not edges.is_empty:
+            node = edges.pop()
+
+            if node == goal:
+                return True, Path.reconstruct(came_from, start, goal), False
+
+            h = heuristic(node, goal)
+            if h < best_h:
+                best, best_h = node, h
+
+            if budget is not None:
+                if budget <= 0:
+                    break
+                budget -= 1
+
+            if deadline is not None and timeit.default_timer() >= deadline:
+                break
+
+            for next_node in graph.neighbours(node, True, filter_func):
+                next_cost = cost_map[node] + graph.cost(next_node)
+                if next_node not in cost_map or next_cost < cost_map[next_node]:
+                    cost_map[next_node] = next_cost
+                    edges.put(next_node, next_cost + cost_mult * heuristic(next_node, goal))
+                    came_from[next_node] = node
+
+        path = Path.reconstruct(came_from, start, best)
+        return len(path) > 1, path, True
+
+    @staticmethod
+    def a_star_partial_proxy(graph, start, goal, on_finish, budget=None, deadline=None, cost_mult=1, heuristic=None, filter_func=None):
+        # the partial flag is left out, so that callbacks take the same arguments as for other searches
+        success, path, _ = Path.a_star_partial(graph, start, goal, budget, deadline, cost_mult, heuristic, filter_func)
+        on_finish(success, path)
+
+    @staticmethod
+    def ara_star_search(graph, start, goal, cost_mult=2.5, mult_step=0.5, deadline=None, heuristic=None, filter_func=None):
+        """Performs an anytime repairing A* (ARA*) search. A fast path is found using
+        the heuristic inflated by cost_mult, which is then lowered by mult_step for each
+        following pass, reusing the search state, until the path is optimal or the deadline
+        (as a timeit.default_timer timestamp) has passed. Returns the last path found"""
+
+        cost_map = {start: 0}
+        came_from = {start: None}
+
+        if start == goal:
+            return True, [goal]
+
+        if heuristic is None:
+            heuristic = lambda node, goal: 0
+
+        edges = PriorityQueue()
+        edges.put(start, cost_mult * heuristic(start, goal))
+        closed = set()
+        incons = set()
+        found = False
+
+        while True:
+
+            # expand until no open node can improve the current path to the goal
+            while not edges.is_empty:
+                priority, node = edges.heap[0]
+
+                if goal in cost_map and cost_map[goal] <= priority:
+                    break
+
+                edges.pop()
+
+                if node in closed or priority > cost_map[node] + cost_mult * heuristic(node, goal):
+                    continue
+
+                closed.add(node)
+
+                for next_node in graph.neighbours(node, True, filter_func):
+                    next_cost = cost_map[node] + graph.cost(next_node)
+                    if next_node not in cost_map or next_cost < cost_map[next_node]:
+                        cost_map[next_node] = next_cost
+                        came_from[next_node] = node
+
+                        if next_node in closed:
+                            incons.add(next_node)
+                        else:
+                            edges.put(next_node, next_cost + cost_mult * heuristic(next_node, goal))
+
+                if found and deadline is not None and timeit.default_timer() >= deadline:
+                    break
+
+            if goal not in cost_map:
+                return False, []
+
+            found = True
+
+            if cost_mult <= 1 or (deadline is not None and timeit.default_timer() >= deadline):
+                return True, Path.reconstruct(came_from, start, goal)
+
+            # deflate the heuristic, and move inconsistent nodes back into the open set
+            cost_mult = max(1, cost_mult - mult_step)
+            reopen = incons.union(node for priority, node in edges.heap if node not in closed)
+            edges = PriorityQueue()
+            for node in reopen:
+                edges.put(node, cost_map[node] + cost_mult * heuristic(node, goal))
+            closed = set()
+            incons = set()
+
+    @staticmethod
+    def ara_star_proxy(graph, start, goal, on_finish, cost_mult=2.5, mult_step=0.5, deadline=None, heuristic=None, filter_func=None):
+        success, path = Path.ara_star_search(graph, start, goal, cost_mult, mult_step, deadline, heuristic, filter_func)
+        on_finish(success, path)
+
+    @staticmethod
+    def greedy_prefix(graph, start, goal, length, budget, heuristic, filter_func=None):
+        """Performs a greedy best-first search for at most budget expansions,
+        returning the first length nodes of the path towards the node closest to the goal"""
+
+        came_from = {start: None}
+        best = start
+        best_h = heuristic(start, goal)
+
+        edges = PriorityQueue()
+        edges.put(start, best_h)
+
+        while not edges.is_empty and budget > 0:
+            node = edges.pop()
+            budget -= 1
+
+            if node == goal:
+                best = node
+                break
+
+            for next_node in graph.neighbours(node, True, filter_func):
+                if next_node not in came_from:
+                    came_from[next_node] = node
+                    h = heuristic(next_node, goal)
+                    edges.put(next_node, h)
+
+                    if h < best_h:
+                        best, best_h = next_node, h
+
+        return Path.reconstruct(came_from, start, best)[:length]
+
+    @staticmethod
+    def a_star_stream(graph, start, goal, on_partial, on_finish, length, budget, cost_mult=1, heuristic=None, filter_func=None):
+        """Delivers a provisional greedy prefix through on_partial, followed by
+        the refined A* remainder from the end of the prefix through on_finish"""
+
+        prefix = Path.greedy_prefix(graph, start, goal, length, budget, heuristic, filter_func)
+
+        if len(prefix) > 1:
+            on_partial(prefix)
+
+        success, path = Path.a_star_search(graph, prefix[-1], goal, cost_mult, heuristic, filter_func)
+        on_finish(success, path)
+
     @staticmethod
     def dijkstras_nearest(graph, start, goal_func, filter_func=None):
 
@@ -230,6 +525,50 @@ class Path:
 
         return False, []
 
+    @staticmethod
+    def dijkstras_multi_source(graph, sources, targets, filter_func=None, max_cost=None):
+        """Performs one Dijkstra search from several sources at once, yielding
+        (target, source, cost) for every reachable target cell, nearest first,
+        where source is the nearest source to that target.
+        The search ends once every target has been yielded, or once the
+        nearest unexpanded cell costs more than max_cost, if given"""
+
+        remaining = len(targets)
+        cost_map = {}
+        origin = {}
+        edges = PriorityQueue()
+
+        for source in sources:
+            cost_map[source] = 0
+            origin[source] = source
+            edges.put(source, 0)
+
+        closed = set()
+
+        while not edges.is_empty:
+            node = edges.pop()
+
+            if node in closed:
+                continue
+
+            closed.add(node)
+
+            if max_cost is not None and cost_map[node] > max_cost:
+                return
+
+            if node in targets:
+                yield node, origin[node], cost_map[node]
+                remaining -= 1
+                if remaining == 0:
+                    return
+
+            for next_node in graph.neighbours(node, True, filter_func):
+                next_cost = cost_map[node] + graph.cost(next_node)
+                if next_node not in cost_map or next_cost < cost_map[next_node]:
+                    cost_map[next_node] = next_cost
+                    origin[next_node] = origin[node]
+                    edges.put(next_node, next_cost)
+
     @staticmethod
     def dijkstras_proxy(graph, start, goal_func, on_finish, filter_func=None):
         success, path = Path.dijkstras_nearest(graph, start, goal_func, filter_func)
@@ -0,0 +1,381 @@
+""" Runs the colony simulation split into regions, one worker process per region.
+Each region owns the units standing in a strip of map columns, with its own
+path thread and timer queue, and keeps a replica of the shared map state.
+Regions step in lock-step; after every step, units that crossed a border,
+messages for units elsewhere and changes to the map are exchanged over pipes,
+taking effect in the other regions at the start of the next step.
+Resource counts are decided by the region owning the column of their cell """
+
+import multiprocessing
+import random
+import timeit
+from bisect import bisect_right
+from collections import Counter
+
+import numpy as np
+
+from config import *
+from telegram import Telegram
+from unit import Goto, PathStates, Unit, spawn_colony
+from world import BuildingTypes, ResourceTypes, World, parse_map
+
+
+def region_columns(width, regions):
+    """Returns the first column of each of a number of equal strips of a map"""
+    return [width * i // regions for i in range(regions)]
+
+class RegionWorld(World):
+    """A world simulating the units in one region of the map. Changes to the map,
+    messages to units in other regions, and units leaving the region
+    are collected for the coordinator after every step.
+    Every region spawns a colony of its own, and units keep their IDs when they
+    migrate, so the colony of a unit is the region its ID was handed out by"""
+
+    def __init__(self, grid, index, starts):
+        super().__init__(grid)
+        self.index = index
+        self.starts = starts
+        self.columns = (starts[index], starts[index + 1] if index + 1 < len(starts) else grid.width)
+        # keep agent IDs unique across regions
+        self._next_id = index * SHARD_ID_STRIDE
+
+        self._by_slot = {}
+        self._events = []
+        self._outgoing = []
+        self._applying = False
+        self.migrated = 0
+
+        grid.on_terrain_changed.append(self._on_terrain_changed)
+
+    @staticmethod
+    def colony_of(agent_id) -> int:
+        """Returns the index of the region that spawned an agent"""
+        return agent_id // SHARD_ID_STRIDE
+
+    def hears(self, agent_id, telegram) -> bool:
+        # broadcasts stay within the colony of the sender
+        return self.colony_of(agent_id) == self.colony_of(telegram.sender_id)
+
+    def region_of(self, cell) -> int:
+        """Returns the index of the region owning a cell"""
+        return bisect_right(self.starts, cell[0]) - 1
+
+    def register_agent(self, agent, agent_id=None) -> int:
+        self._by_slot[agent.slot] = agent
+        return super().register_agent(agent, agent_id)
+
+    def remove_agent(self, agent_id: int):
+        agent = self.agents.get(agent_id)
+        if agent is not None:
+            self._by_slot.pop(agent.slot, None)
+        super().remove_agent(agent_id)
+
+    def _on_terrain_changed(self, cell, terrain):
+        if not self._applying:
+            self._events.append(("tile", cell, terrain, self.graph.get_tile(cell)[1]))
+
+    def reveal(self, cell):
+        fogged = self.graph.get_fog(cell)
+        discovered = super().reveal(cell)
+        if (fogged or discovered) and not self._applying:
+            self._events.append(("fog", cell))
+        return discovered
+
+    def add_location(self, location, location_type):
+        super().add_location(location, location_type)
+        if not self._applying:
+            self._events.append(("building", location, location_type))
+
+    def add_resource(self, location, resource, count=1):
+        """Adds resources to a cell. Changes to cells owned by this region are sent
+        to the others as the new count. Changes to cells owned by another region
+        are applied here at once, and sent to the owner as a request, which
+        answers with the count it decided on, overwriting the local one"""
+
+        current = super().add_resource(location, resource, count)
+
+        if not self._applying:
+            if self.region_of(location) == self.index:
+                self._events.append(("count", location, resource, current))
+            else:
+                self._events.append(("request", location, resource, count))
+
+        return current
+
+    def _set_resource(self, location, resource, count):
+        """Internal - overwrite the count of a resource at a cell"""
+        return World.add_resource(self, location, resource, count - self.get_resource(location, resource))
+
+    def dispatch(self, telegram: Telegram, delay=0):
+        """Dispatches a message as usual, also passing it on to the coordinator
+        if it is a broadcast, or if any receiver is not in this region"""
+
+        if delay <= 0:
+            receiver = telegram.receiver_id
+
+            if receiver is None:
+                self._outgoing.append(telegram)
+            elif isinstance(receiver, int):
+                if receiver not in self.agents:
+                    self._outgoing.append(telegram)
+            else:
+                remote = tuple(agent_id for agent_id in receiver if agent_id not in self.agents)
+                if remote:
+                    self._outgoing.append(Telegram(telegram.sender_id, remote, telegram.message, telegram.data, telegram.cell))
+
+        return super().dispatch(telegram, delay)
+
+    def apply(self, events):
+        """Applies map changes made in other regions"""
+
+        self._applying = True
+
+        for event in events:
+            if event[0] == "tile":
+                self.graph.set_tile(event[1], event[2], event[3])
+            elif event[0] == "fog":
+                self.reveal(event[1])
+            elif event[0] == "building":
+                self.add_location(event[1], event[2])
+            elif event[0] == "count":
+                self._set_resource(event[1], event[2], event[3])
+            elif event[0] == "request" and self.region_of(event[1]) == self.index:
+                self._grant(event[1], event[2], event[3])
+
+        self._applying = False
+
+    def _grant(self, location, resource, count):
+        """Internal - apply a change requested by another region to a cell owned by this one,
+        refusing to take more than is there, and send out the resulting count.
+        A unit that was refused keeps what it took in its own region"""
+
+        current = self.get_resource(location, resource)
+        count = max(count, -current)
+        if count != 0:
+            World.add_resource(self, location, resource, count)
+        self._events.append(("count", location, resource, current + count))
+
+    def receive(self, inbox):
+        """Takes in the units, map changes and messages sent from other regions"""
+
+        self.apply(inbox["events"])
+
+        for data in inbox["units"]:
+            Unit.restore(self, data)
+
+        for telegram in inbox["telegrams"]:
+            if telegram.receiver_id is None:
+                # broadcasts have already been passed to every region
+                World.dispatch(self, telegram)
+            else:
+                self.dispatch(telegram)
+
+    def _emigrants(self):
+        """Exports units standing outside the region, returning (region, data) pairs.
+        Only units walking a finished path are moved, since they have no path queries
+        in flight; others stay until they next walk"""
+
+        size = len(self.units.alive)
+        x = self.units.position[:size, 0]
+        outside = self.units.alive & ((x < self.columns[0]) | (x >= self.columns[1]))
+
+        leaving = []
+        for slot in outside.nonzero()[0].tolist():
+            agent = self._by_slot[slot]
+            state = agent.state
+            if isinstance(state, Goto) and state.state is PathStates.Working and not state.streaming:
+                leaving.append(agent)
+
+        emigrants = []
+        for agent in leaving:
+            region = self.region_of(agent.location)
+            emigrants.append((region, agent.export()))
+
+        self.migrated += len(emigrants)
+        return emigrants
+
+    def collect(self):
+        """Returns and clears everything to send to other regions after a step"""
+
+        outbox = {"units": self._emigrants(), "events": self._events, "telegrams": self._outgoing}
+        self._events = []
+        self._outgoing = []
+        return outbox
+
+    def stats(self) -> dict:
+        """Returns the counters of this region"""
+
+        return {
+            "messages_sent": self.messages_sent,
+            "path_latency": list(self.path_latency),
+            "units": len(self.agents),
+            "active": self.active_count,
+            "migrated": self.migrated,
+            # count only owned cells, since other cells may be waiting on an answer
+            "resources": {res.name: sum(self.get_resource(cell, res) for cell in self.resources.cells(res)
+                                        if self.region_of(cell) == self.index) for res in ResourceTypes},
+            "buildings": {building.name: self.buildings.count(building) for building in BuildingTypes},
+            "states": {state.__name__: count for state, count in self.units.state_counts().items()},
+        }
+
+def run_region(conn, lines, index, regions, seed, sync_paths):
+    """Runs in a worker process, serving commands from the coordinator over a pipe"""
+
+    if seed is not None:
+        random.seed(seed + index)
+
+    grid = parse_map(lines)
+    world = RegionWorld(grid, index, region_columns(grid.width, regions))
+
+    while True:
+        command, *args = conn.recv()
+
+        if command == "spawn":
+            spawn_cell, units = spawn_colony(world, args[0], world.columns)
+            world.reveal(spawn_cell)
+            conn.send(([unit.agent_id for unit in units], world.collect()))
+
+        elif command == "step":
+            world.receive(args[1])
+            world.step_forward(args[0])
+            if sync_paths:
+                world.wait_for_paths()
+            conn.send(world.collect())
+
+        elif command == "stats":
+            world.receive(args[0])
+            conn.send(world.stats())
+
+        elif command == "close":
+            conn.close()
+            return
+
+class ShardedWorld:
+    """Coordinates a map split into regions, each simulated in a worker process.
+    Routes units, map changes and messages between the regions after every step"""
+
+    def __init__(self, lines, regions, seed=None, sync_paths=True):
+        self.regions = regions
+        self._owners = {}       # agent ID -> region
+        self._inboxes = [self._empty_inbox() for _ in range(regions)]
+        self._conns = []
+        self._procs = []
+
+        for index in range(regions):
+            parent, child = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=run_region, args=(child, lines, index, regions, seed, sync_paths), daemon=True)
+            proc.start()
+            child.close()
+            self._conns.append(parent)
+            self._procs.append(proc)
+
+    @staticmethod
+    def _empty_inbox():
+        return {"units": [], "events": [], "telegrams": []}
+
+    def _route(self, index, outbox):
+        """Sorts the outbox of a region into the inboxes of the others"""
+
+        for region, data in outbox["units"]:
+            self._owners[data["agent_id"]] = region
+            self._inboxes[region]["units"].append(data)
+
+        for other in range(self.regions):
+            if other != index:
+                self._inboxes[other]["events"].extend(outbox["events"])
+
+        for telegram in outbox["telegrams"]:
+            receiver = telegram.receiver_id
+
+            if receiver is None:
+                for other in range(self.regions):
+                    if other != index:
+                        self._inboxes[other]["telegrams"].append(telegram)
+            elif isinstance(receiver, int):
+                region = self._owners.get(receiver)
+                if region is not None and region != index:
+                    self._inboxes[region]["telegrams"].append(telegram)
+            else:
+                by_region = {}
+                for agent_id in receiver:
+                    region = self._owners.get(agent_id)
+                    if region is not None and region != index:
+                        by_region.setdefault(region, []).append(agent_id)
+                for region, ids in by_region.items():
+                    self._inboxes[region]["telegrams"].append(
+                        Telegram(telegram.sender_id, tuple(ids), telegram.message, telegram.data, telegram.cell))
+
+    def _exchange(self, commands):
+        """Sends one command to every region, then routes their replies"""
+
+        for conn, command in zip(self._conns, commands):
+            conn.send(command)
+
+        replies = [conn.recv() for conn in self._conns]
+        self._inboxes = [self._empty_inbox() for _ in range(self.regions)]
+        return replies
+
+    def spawn(self, count):
+        """Spawns a colony of a number of units in every region"""
+
+        replies = self._exchange([("spawn", count)] * self.regions)
+
+        for index, (agent_ids, outbox) in enumerate(replies):
+            for agent_id in agent_ids:
+                self._owners[agent_id] = index
+            self._route(index, outbox)
+
+    def step_forward(self, step=1):
+        """Steps every region once, in parallel"""
+
+        replies = self._exchange([("step", step, inbox) for inbox in self._inboxes])
+
+        for index, outbox in enumerate(replies):
+            self._route(index, outbox)
+
+    def stats(self) -> list:
+        """Delivers anything still in transit, and returns the counters of every region"""
+        return self._exchange([("stats", inbox) for inbox in self._inboxes])
+
+    def close(self):
+        for conn in self._conns:
+            conn.send(("close",))
+        for proc in self._procs:
+            proc.join()
+
+def run(ticks, step, units, lines, regions, seed=None, sync_paths=True):
+    """Simulates one colony per region for a number of fixed steps, returning
+    the same counters as headless.run, along with the number of migrations"""
+
+    world = ShardedWorld(lines, regions, seed, sync_paths)
+    world.spawn(max(units // regions, INIT_SCOUT + INIT_LOGGER + 2))
+
+    start = timeit.default_timer()
+    for _ in range(ticks):
+        world.step_forward(step)
+    elapsed = timeit.default_timer() - start
+
+    region_stats = world.stats()
+    world.close()
+
+    latency = np.array([sample for stats in region_stats for sample in stats["path_latency"]]) * 1000
+    percentiles = np.percentile(latency, (50, 90, 99)).tolist() if len(latency) > 0 else [None] * 3
+    states = sum((Counter(stats["states"]) for stats in region_stats), Counter())
+
+    return {
+        "ticks": ticks,
+        "seconds": elapsed,
+        "ticks_per_sec": ticks / elapsed if elapsed > 0 else float("inf"),
+        "sim_time": ticks * step,
+        "messages_per_tick": sum(stats["messages_sent"] for stats in region_stats) / ticks,
+        "path_queries": len(latency),
+        "path_latency_ms": dict(zip(("p50", "p90", "p99"), percentiles)),
+        "units": sum(stats["units"] for stats in region_stats),
+        "active": sum(stats["active"] for stats in region_stats),
+        "resources": {res.name: sum(stats["resources"][res.name] for stats in region_stats) for res in ResourceTypes},
+        # buildings are replicated, so every region holds the same counts
+        "buildings": region_stats[0]["buildings"],
+        "states": dict(states),
+        "regions": regions,
+        "migrations": sum(stats["migrated"] for stats in region_stats),
+    }
@@ -0,0 +1,415 @@
+""" Spatial indices for locating things in the world """
+
+from collections import defaultdict
+from random import choice, choices, randrange
+
+class BuildingRegistry:
+    """Registry of buildings, indexed both by cell and by type,
+    with nearest-of-type queries and typed change notifications"""
+
+    def __init__(self):
+        self._cells = {}
+        self._types = defaultdict(dict)
+        self._listeners = defaultdict(list)
+
+    def __contains__(self, cell):
+        return cell in self._cells
+
+    def __getitem__(self, cell):
+        return self._cells[cell]
+
+    def __iter__(self):
+        return iter(self._cells)
+
+    def __len__(self):
+        return len(self._cells)
+
+    def get(self, cell, default=None):
+        """Returns the type of building at a cell, or default if there is none"""
+        return self._cells.get(cell, default)
+
+    def items(self):
+        return self._cells.items()
+
+    def add(self, cell, building_type):
+        """Adds a building at a cell, replacing any existing building,
+        and notifies listeners of the new building type"""
+
+        previous = self._cells.get(cell)
+        if previous is not None:
+            self._types[previous].pop(cell, None)
+
+        self._cells[cell] = building_type
+        self._types[building_type][cell] = None
+        self._notify(cell, building_type)
+
+    def remove(self, cell):
+        """Removes the building at a cell, notifying listeners with a building type of None"""
+
+        building_type = self._cells.pop(cell, None)
+        if building_type is not None:
+            self._types[building_type].pop(cell, None)
+            for callback in self._listeners[building_type] + self._listeners[None]:
+                callback(cell, None)
+
+    def of_type(self, building_type) -> list:
+        """Returns a list of the cells of all buildings of a type, in order of construction"""
+        return list(self._types.get(building_type, ()))
+
+    def count(self, building_type) -> int:
+        """Returns the number of buildings of a type"""
+        return len(self._types.get(building_type, ()))
+
+    def nearest(self, building_type, cell):
+        """Returns the cell of the building of a type closest to a cell, or None if there is none"""
+
+        x, y = cell
+        cells = self._types.get(building_type)
+        if not cells:
+            return None
+
+        return min(cells, key=lambda c: (c[0] - x) ** 2 + (c[1] - y) ** 2)
+
+    def subscribe(self, callback, building_type=None):
+        """Registers a callback taking (cell, building_type), called when a building
+        of the specified type is added, or for all buildings if no type is provided"""
+        self._listeners[building_type].append(callback)
+
+    def unsubscribe(self, callback, building_type=None):
+        if callback in self._listeners[building_type]:
+            self._listeners[building_type].remove(callback)
+
+    def _notify(self, cell, building_type):
+        """Internal - call all listeners for a building type"""
+        for callback in self._listeners[building_type]:
+            callback(cell, building_type)
+        for callback in self._listeners[None]:
+            callback(cell, building_type)
+
+class SpatialHash:
+    """Uniform grid of buckets, hashing objects by position
+    for same-cell and radius queries"""
+
+    def __init__(self, bucket_size=8):
+        self.bucket_size = bucket_size
+        self._buckets = defaultdict(dict)
+        self._positions = {}
+
+    def __contains__(self, obj):
+        return obj in self._positions
+
+    def __len__(self):
+        return len(self._positions)
+
+    def _bucket(self, position):
+        """Internal - get the bucket key of a position"""
+        return int(position[0]) // self.bucket_size, int(position[1]) // self.bucket_size
+
+    def move(self, obj, position):
+        """Inserts an object at a position, or moves it there if already present"""
+
+        position = tuple(position)
+        bucket = self._bucket(position)
+        previous = self._positions.get(obj)
+
+        if previous is not None:
+            previous_bucket = self._bucket(previous)
+            if previous_bucket != bucket:
+                self._remove_from_bucket(obj, previous_bucket)
+
+        self._positions[obj] = position
+        self._buckets[bucket][obj] = position
+
+    def remove(self, obj):
+        """Removes an object from the hash"""
+
+        position = self._positions.pop(obj, None)
+        if position is not None:
+            self._remove_from_bucket(obj, self._bucket(position))
+
+    def _remove_from_bucket(self, obj, bucket):
+        """Internal - remove an object from a bucket, dropping the bucket if empty"""
+
+        contents = self._buckets[bucket]
+        contents.pop(obj, None)
+        if len(contents) == 0:
+            self._buckets.pop(bucket)
+
+    def at(self, position) -> list:
+        """Returns all objects at exactly the specified position"""
+
+        position = tuple(position)
+        contents = self._buckets.get(self._bucket(position), {})
+        return [obj for obj, pos in contents.items() if pos == position]
+
+    def near(self, position, radius) -> list:
+        """Returns all objects within a square of the specified radius around a position"""
+
+        x, y = position
+        min_x, min_y = self._bucket((x - radius, y - radius))
+        max_x, max_y = self._bucket((x + radius, y + radius))
+        found = []
+
+        for b_y in range(min_y, max_y + 1):
+            for b_x in range(min_x, max_x + 1):
+                contents = self._buckets.get((b_x, b_y))
+                if contents is None:
+                    continue
+                for obj, pos in contents.items():
+                    if abs(pos[0] - x) <= radius and abs(pos[1] - y) <= radius:
+                        found.append(obj)
+
+        return found
+
+class ResourceIndex:
+    """Index of resource piles, keeping per-type totals and bucketed
+    spatial storage for k-nearest queries"""
+
+    def __init__(self, bucket_size=8):
+        self.bucket_size = bucket_size
+        self._piles = defaultdict(dict)
+        self._totals = defaultdict(int)
+        self._buckets = defaultdict(lambda: defaultdict(set))
+
+    def __contains__(self, resource):
+        return len(self._piles.get(resource, ())) > 0
+
+    def _bucket(self, cell):
+        """Internal - get the bucket key of a cell"""
+        return cell[0] // self.bucket_size, cell[1] // self.bucket_size
+
+    def add(self, cell, resource, count=1) -> int:
+        """Adds (or removes, if negative) resources to a cell, returning the new count there"""
+
+        piles = self._piles[resource]
+        current = piles.get(cell, 0) + count
+        self._totals[resource] += count
+
+        if current == 0:
+            if cell in piles:
+                piles.pop(cell)
+                bucket = self._bucket(cell)
+                buckets = self._buckets[resource]
+                buckets[bucket].discard(cell)
+                if len(buckets[bucket]) == 0:
+                    buckets.pop(bucket)
+        else:
+            if cell not in piles:
+                self._buckets[resource][self._bucket(cell)].add(cell)
+            piles[cell] = current
+
+        return current
+
+    def get(self, cell, resource) -> int:
+        """Returns the number of resources of a type at a cell"""
+        return self._piles.get(resource, {}).get(cell, 0)
+
+    def total(self, resource) -> int:
+        """Returns the total number of resources of a type in the world"""
+        return self._totals.get(resource, 0)
+
+    def cells(self, resource) -> list:
+        """Returns a list of all cells holding resources of a type"""
+        return list(self._piles.get(resource, ()))
+
+    def nearest(self, resource, cell, k=1, exclude=None) -> list:
+        """Returns up to k cells holding resources of a type, ordered by distance to a cell,
+        searching rings of buckets outwards until no closer pile can be found"""
+
+        buckets = self._buckets.get(resource)
+        if not buckets:
+            return []
+
+        x, y = cell
+        c_x, c_y = self._bucket(cell)
+        max_ring = max(max(abs(b_x - c_x), abs(b_y - c_y)) for b_x, b_y in buckets)
+        found = []
+
+        for ring in range(max_ring + 1):
+            for b_y in range(c_y - ring, c_y + ring + 1):
+                for b_x in range(c_x - ring, c_x + ring + 1):
+                    if max(abs(b_x - c_x), abs(b_y - c_y)) != ring:
+                        continue
+                    for pile in buckets.get((b_x, b_y), ()):
+                        if exclude is None or pile not in exclude:
+                            found.append(((pile[0] - x) ** 2 + (pile[1] - y) ** 2, pile))
+
+            # piles in further rings are at least this far away
+            if len(found) >= k:
+                found.sort()
+                if found[k - 1][0] <= (ring * self.bucket_size + 1) ** 2:
+                    break
+
+        found.sort()
+        return [pile for distance, pile in found[:k]]
+
+class IndexedSet:
+    """A set supporting O(1) insertion, removal and uniform random choice"""
+
+    def __init__(self):
+        self._items = []
+        self._index = {}
+
+    def __contains__(self, item):
+        return item in self._index
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def add(self, item):
+        if item not in self._index:
+            self._index[item] = len(self._items)
+            self._items.append(item)
+
+    def discard(self, item):
+        """Removes an item by swapping the last item into its place"""
+
+        i = self._index.pop(item, None)
+        if i is not None:
+            last = self._items.pop()
+            if i < len(self._items):
+                self._items[i] = last
+                self._index[last] = i
+
+    def choice(self):
+        return self._items[randrange(len(self._items))]
+
+class FreeCellSampler:
+    """Keeps track of free cells without buildings, grouped by connected component
+    and spatial bucket, for sampling random cells in O(1).
+    Components are recalculated lazily when a cell changes between free and blocked"""
+
+    sample_attempts = 8
+
+    def __init__(self, graph, buildings, bucket_size=8):
+        self.graph = graph
+        self.buildings = buildings
+        self.bucket_size = bucket_size
+        self._free = set()
+        self._components = {}
+        self._all = IndexedSet()
+        self._buckets = defaultdict(dict)
+        self._dirty = True
+
+        graph.on_terrain_changed.append(self.on_terrain_changed)
+        buildings.subscribe(self.on_building_changed)
+
+    def _bucket(self, cell):
+        """Internal - get the bucket key of a cell"""
+        return cell[0] // self.bucket_size, cell[1] // self.bucket_size
+
+    def _rebuild(self):
+        """Internal - label connected components with a flood fill, and fill the buckets"""
+
+        graph = self.graph
+        self._free = {(x, y) for y in range(graph.height) for x in range(graph.width) if graph.is_free((x, y))}
+        self._components = {}
+        self._all = IndexedSet()
+        self._buckets = defaultdict(dict)
+
+        label = 0
+        for cell in self._free:
+            if cell in self._components:
+                continue
+
+            label += 1
+            self._components[cell] = label
+            stack = [cell]
+
+            while len(stack) > 0:
+                node = stack.pop()
+                for next_node in graph.neighbours(node):
+                    if next_node not in self._components:
+                        self._components[next_node] = label
+                        stack.append(next_node)
+
+        for cell in self._free:
+            if cell not in self.buildings:
+                self._add(cell)
+
+        self._dirty = False
+
+    def _add(self, cell):
+        """Internal - make a cell available for sampling"""
+        self._all.add(cell)
+        bucket = self._buckets[self._bucket(cell)]
+        label = self._components[cell]
+        if label not in bucket:
+            bucket[label] = IndexedSet()
+        bucket[label].add(cell)
+
+    def _discard(self, cell):
+        """Internal - make a cell unavailable for sampling"""
+        self._all.discard(cell)
+        bucket = self._buckets.get(self._bucket(cell), {})
+        cells = bucket.get(self._components.get(cell))
+        if cells is not None:
+            cells.discard(cell)
+
+    def on_terrain_changed(self, cell, terrain):
+        if (cell in self._free) != self.graph.is_free(cell):
+            self._dirty = True
+
+    def on_building_changed(self, cell, building_type):
+        if self._dirty or cell not in self._free:
+            return
+        if building_type is None:
+            self._add(cell)
+        else:
+            self._discard(cell)
+
+    def component(self, cell):
+        """Returns the label of the connected component of a cell, or None if it is blocked"""
+        if self._dirty:
+            self._rebuild()
+        return self._components.get(cell)
+
+    def sample(self, origin=None, radius=None, reachable=True):
+        """Returns a random free cell without a building, or None if there is none.
+        If an origin is provided, the cell is within a square radius of it (if any),
+        and, if reachable is set, in the same connected component"""
+
+        if self._dirty:
+            self._rebuild()
+
+        if origin is None:
+            return self._all.choice() if len(self._all) > 0 else None
+
+        label = self._components.get(origin) if reachable else None
+
+        if radius is None:
+            min_x, min_y = 0, 0
+            max_x, max_y = self.graph.width - 1, self.graph.height - 1
+        else:
+            min_x, min_y = origin[0] - radius, origin[1] - radius
+            max_x, max_y = origin[0] + radius, origin[1] + radius
+
+        b_min_x, b_min_y = self._bucket((max(min_x, 0), max(min_y, 0)))
+        b_max_x, b_max_y = self._bucket((max_x, max_y))
+        candidates = []
+
+        for b_y in range(b_min_y, b_max_y + 1):
+            for b_x in range(b_min_x, b_max_x + 1):
+                bucket = self._buckets.get((b_x, b_y))
+                if bucket is None:
+                    continue
+                if label is None:
+                    candidates.extend(cells for cells in bucket.values() if len(cells) > 0)
+                elif label in bucket and len(bucket[label]) > 0:
+                    candidates.append(bucket[label])
+
+        if len(candidates) == 0:
+            return None
+
+        # sample buckets weighted by size, rejecting cells outside the radius
+        weights = [len(cells) for cells in candidates]
+        for i in range(self.sample_attempts):
+            cell = choices(candidates, weights)[0].choice()
+            if min_x <= cell[0] <= max_x and min_y <= cell[1] <= max_y:
+                return cell
+
+        inside = [cell for cells in candidates for cell in cells if min_x <= cell[0] <= max_x and min_y <= cell[1] <= max_y]
+        return choice(inside) if len(inside) > 0 else None
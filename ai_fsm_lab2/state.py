@@ -1,12 +1,58 @@
 from __future__ import annotations
+import threading
 from abc import ABC
+from collections import defaultdict
+from itertools import islice
+
+class StateIndex:
+    """Index of FSM contexts by the type of their current state, including
+    base state types, kept up to date by the contexts themselves"""
+
+    def __init__(self):
+        self._contexts = defaultdict(dict)
+        self._types = {}
+        self._lock = threading.Lock()
+
+    def _state_types(self, state):
+        """Internal - get the state types a state should be indexed under"""
+
+        state_type = type(state)
+        types = self._types.get(state_type)
+
+        if types is None:
+            types = [t for t in state_type.__mro__ if issubclass(t, State) and t is not State]
+            self._types[state_type] = types
+
+        return types
+
+    def add(self, context, state):
+        """Index a context under the types of a state"""
+        if state is not None:
+            with self._lock:
+                for state_type in self._state_types(state):
+                    self._contexts[state_type][context] = None
+
+    def remove(self, context, state):
+        """Remove a context from the types of a state"""
+        if state is not None:
+            with self._lock:
+                for state_type in self._state_types(state):
+                    self._contexts[state_type].pop(context, None)
+
+    def count(self, state_type) -> int:
+        """Returns the number of contexts in a state type"""
+        return len(self._contexts.get(state_type, ()))
+
+    def get(self, state_type, count=None) -> list:
+        """Returns a list of contexts in a state type (or subtype), in order of entry"""
+        with self._lock:
+            contexts = self._contexts.get(state_type, {})
+            return list(contexts if count is None else islice(contexts, count))
 
 class StateContext(ABC):
     """FSM context - provides FSM capabilities to objects inheriting from it"""
 
-    _global_state: State = None
-    _current_state: State = None
-    _previous_state: State = None
+    __slots__ = ("_global_state", "_current_state", "_previous_state", "_state_index", "_step_debt", "blackboard")
 
     @property
     def state(self) -> State:
@@ -15,6 +61,11 @@ class StateContext(ABC):
     def __init__(self, initial_state: State, global_state: State):
         self._current_state = initial_state
         self._global_state = global_state
+        self._previous_state: State = None
+        self._state_index: StateIndex = None
+        self._step_debt = 0
+        # per-context data of shared states, which keep none of their own
+        self.blackboard = {}
 
     def change_state(self, state: State, do_exit=True):
         """Change to a new state, optionally omitting exiting current state,
@@ -26,7 +77,12 @@ class StateContext(ABC):
         if self._current_state is not None and do_exit:
             self._current_state.exit(self)
 
+        if self._state_index is not None:
+            self._state_index.remove(self, self._current_state)
+            self._state_index.add(self, state)
+
         self._current_state = state
+        self.wake()
         self._current_state.enter(self)
 
     def revert_state(self):
@@ -42,16 +98,30 @@ class StateContext(ABC):
         if self._current_state is not None:
             self._current_state.enter(self)
 
-    def update(self, step=1):
+    def update(self, step=1, tick=None):
         """Moves the FSM ahead a step of specified size.
-        Step size is passed to update functions."""
+        Step size is passed to update functions. If a tick is given, states with a
+        think interval only execute on every n:th tick, with the steps accumulated since"""
+
+        self._step_debt += step
+        interval = self._current_state.think_interval if self._current_state is not None else 1
+        if tick is not None and interval > 1 and tick % interval != 0:
+            return
+
+        step, self._step_debt = self._step_debt, 0
+
         if self._global_state is not None and not self._current_state.ignore_global:
             self._global_state.execute(self, step)
         if self._current_state is not None:
             self._current_state.execute(self, step)
 
+    def wake(self):
+        """Gets called when the context changes state or receives a message,
+        so that contexts which can sleep are updated again"""
+
     def handle_message(self, message):
         """Sends a message to the current state, or if not handled; the global state"""
+        self.wake()
         if self._current_state is not None and self._current_state.on_message(self, message):
             return True
         if self._global_state is not None and self._global_state.on_message(self, message):
@@ -66,6 +136,29 @@ class State(ABC):
     # Set to false if the state is temporary, and should not be saved in previous state variable
     revertable = True
 
+    # Number of ticks between executions, for states that need not think every tick
+    think_interval = 1
+
+    # Set if the state keeps no data of its own, so that one instance can serve every context
+    stateless = False
+
+    @classmethod
+    def shared(cls) -> State:
+        """Returns the one instance of a stateless state type, which keeps
+        its per-context data on the context blackboard"""
+
+        instance = cls.__dict__.get("_instance")
+        if instance is None:
+            instance = cls()
+            cls._instance = instance
+        return instance
+
+    def __reduce_ex__(self, protocol):
+        # shared states unpickle to the shared instance of the receiving process
+        if self.stateless:
+            return type(self).shared, ()
+        return super().__reduce_ex__(protocol)
+
     def enter(self, context):
         """Gets called once while entering the state"""
 
@@ -77,3 +170,31 @@ class State(ABC):
 
     def on_message(self, context, telegram) -> bool:
         """Gets called by the FSM when a message has been received"""
+
+class StatePool:
+    """A free list of state objects of one type, for states entered too often
+    to allocate anew. Reused states are set up again through their reset method,
+    taking the same arguments as the constructor, and must be released once exited"""
+
+    def __init__(self, state_type):
+        self.state_type = state_type
+        self._free = []
+
+    def __len__(self):
+        return len(self._free)
+
+    def acquire(self, *args, **kwargs) -> State:
+        """Returns a released state reset with the arguments, or a new one if none is free"""
+
+        # states may be acquired from the path thread, so pop rather than check first
+        try:
+            state = self._free.pop()
+        except IndexError:
+            return self.state_type(*args, **kwargs)
+
+        state.reset(*args, **kwargs)
+        return state
+
+    def release(self, state):
+        """Returns an exited state to the pool"""
+        self._free.append(state)
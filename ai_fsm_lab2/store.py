@@ -0,0 +1,89 @@
+""" Compact storage of unit data in parallel arrays """
+
+import numpy as np
+
+
+class UnitStore:
+    """Keeps position, speed, color and state of every unit in parallel arrays,
+    indexed by a slot handed out on add. Colors and state types are interned
+    to small integer ids, so systems can read everything as plain arrays"""
+
+    def __init__(self, capacity=64):
+        self.position = np.zeros((capacity, 2), dtype=np.int32)
+        self.speed = np.zeros(capacity, dtype=np.float32)
+        self.color_id = np.zeros(capacity, dtype=np.uint8)
+        self.state_id = np.zeros(capacity, dtype=np.uint16)
+        self.alive = np.zeros(capacity, dtype=bool)
+
+        self.colors = []            # color by id
+        self.state_types = [None]   # state type by id, 0 meaning no state
+        self._color_ids = {}
+        self._state_ids = {None: 0}
+
+        self._free = []
+        self._size = 0
+
+    def __len__(self):
+        return self._size - len(self._free)
+
+    def _grow(self):
+        capacity = len(self.alive) * 2
+        for name in ("position", "speed", "color_id", "state_id", "alive"):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def add(self, location, speed, color) -> int:
+        """Stores a new unit, returning its slot"""
+
+        if self._free:
+            slot = self._free.pop()
+        else:
+            if self._size == len(self.alive):
+                self._grow()
+            slot = self._size
+            self._size += 1
+
+        self.position[slot] = location
+        self.speed[slot] = speed
+        self.color_id[slot] = self.intern_color(color)
+        self.state_id[slot] = 0
+        self.alive[slot] = True
+        return slot
+
+    def remove(self, slot):
+        """Frees the slot of a unit, to be reused by the next add"""
+
+        if self.alive[slot]:
+            self.alive[slot] = False
+            self._free.append(slot)
+
+    def intern_color(self, color) -> int:
+        """Returns the id of a color, assigning a new one if needed"""
+
+        color_id = self._color_ids.get(color)
+        if color_id is None:
+            color_id = self._color_ids[color] = len(self.colors)
+            self.colors.append(color)
+        return color_id
+
+    def intern_state(self, state_type) -> int:
+        """Returns the id of a state type, assigning a new one if needed"""
+
+        state_id = self._state_ids.get(state_type)
+        if state_id is None:
+            state_id = self._state_ids[state_type] = len(self.state_types)
+            self.state_types.append(state_type)
+        return state_id
+
+    def slots(self) -> np.ndarray:
+        """Returns the slots of all stored units"""
+        return self.alive[:self._size].nonzero()[0]
+
+    def state_counts(self) -> dict:
+        """Returns the number of units per exact state type"""
+
+        alive = self.alive[:self._size]
+        counts = np.bincount(self.state_id[:self._size][alive], minlength=len(self.state_types))
+        return {self.state_types[i]: int(n) for i, n in enumerate(counts) if n > 0}
@@ -1,3 +1,4 @@
+from collections import defaultdict
 from enum import Enum, auto
 
 class MessageTypes(Enum):
@@ -10,6 +11,7 @@ class MessageTypes(Enum):
     MSG_FETCH_DONE      = auto()
     MSG_BUILDING_NEEDED = auto()
     MSG_BUILDING_DONE   = auto()
+    MSG_BUILDING_FAIL   = auto()
     MSG_BUILDING_FINISH = auto()
     MSG_CHANGE_STATE    = auto()
 
@@ -19,14 +21,16 @@ class Telegram:
     _receiver_id = 0
     _msg = None
     _data = None
+    _cell = None
 
     dispatch_time = 0
 
-    def __init__(self, sender_id: int, receiver_id: tuple, message, data = None):
+    def __init__(self, sender_id: int, receiver_id: tuple, message, data = None, cell = None):
         self._sender_id = sender_id
         self._receiver_id = receiver_id
         self._msg = message
         self._data = data
+        self._cell = cell
 
     @property
     def sender_id(self) -> int:
@@ -42,4 +46,55 @@ class Telegram:
 
     @property
     def data(self):
-        return self._data
\ No newline at end of file
+        return self._data
+
+    @property
+    def cell(self):
+        """The cell a broadcast concerns, used for routing to cell subscribers"""
+        return self._cell
+
+class MessageBus:
+    """Routes broadcast telegrams to the agents subscribed to their message type,
+    optionally only those concerning a specific cell"""
+
+    def __init__(self):
+        self._subscribers = defaultdict(set)
+        self._subscriptions = defaultdict(set)
+
+    def subscribe(self, agent_id, message, cell=None):
+        """Subscribe an agent to broadcasts of a message type,
+        either all of them, or only those concerning the specified cell"""
+
+        self._subscribers[(message, cell)].add(agent_id)
+        self._subscriptions[agent_id].add((message, cell))
+
+    def unsubscribe(self, agent_id, message=None, cell=None):
+        """Unsubscribe an agent from a message type and cell,
+        or from everything if no message type is provided"""
+
+        if message is None:
+            keys = self._subscriptions.pop(agent_id, set())
+        else:
+            keys = {(message, cell)}
+            self._subscriptions[agent_id].discard((message, cell))
+
+        for key in keys:
+            subscribers = self._subscribers.get(key)
+            if subscribers is not None:
+                subscribers.discard(agent_id)
+                if len(subscribers) == 0:
+                    self._subscribers.pop(key)
+
+    def subscriptions(self, agent_id):
+        """Returns the (message type, cell) pairs an agent is subscribed to"""
+        return set(self._subscriptions.get(agent_id, ()))
+
+    def subscribers(self, telegram):
+        """Returns the ID:s of all agents subscribed to a broadcast telegram"""
+
+        subscribers = set(self._subscribers.get((telegram.message, None), ()))
+
+        if telegram.cell is not None:
+            subscribers.update(self._subscribers.get((telegram.message, telegram.cell), ()))
+
+        return subscribers
@@ -1,11 +1,11 @@
 from __future__ import annotations
 
+from collections import deque
 from enum import Enum, auto
-from math import ceil
-from random import randint
+from random import choice, randint
 
 from config import *
-from state import State, StateContext
+from state import State, StateContext, StatePool
 from telegram import MessageTypes, Telegram
 from world import BuildingTypes, ResourceTypes, TerrainTypes, World
 
@@ -26,26 +26,94 @@ class Actions(Enum):
     Walking     = auto()
 
 class Unit(StateContext):
-    """A class representing a gameworld unit, driven by its current state"""
+    """A class representing a gameworld unit, driven by its current state.
+    The unit is a thin handle, with its data kept in the world's unit store"""
+
+    __slots__ = ("_world", "_store", "_slot", "_id")
 
     def __init__(self, world: World, location, state):
-        super().__init__(state(), UnitGlobal())
+        super().__init__(state.shared() if state.stateless else state(), UnitGlobal.shared())
         self._world = world
-        self._location = list(location)
-        self.speed = UNIT_SPEED
-        self.color = COL_UNIT
+        self._store = world.units
+        self._slot = self._store.add(location, UNIT_SPEED, COL_UNIT)
+        self._store.state_id[self._slot] = self._store.intern_state(type(self.state))
 
+        self._state_index = world.state_index
+        self._state_index.add(self, self.state)
         self._id = self._world.register_agent(self)
 
     def init(self):
         """Gets called by world manager, just before receiving an agent_id
         For delayed initalization of variables that need reference to World"""
 
+    def change_state(self, state: State, do_exit=True):
+        super().change_state(state, do_exit)
+        self._store.state_id[self._slot] = self._store.intern_state(type(self.state))
+
+    def sleep(self, duration=None):
+        """Stops updating the unit until it changes state or receives a message,
+        or until the optional duration has passed"""
+        self._world.sleep(self, duration)
+
+    def wake(self):
+        self._world.wake(self)
+
+    def export(self) -> dict:
+        """Removes the unit from its world, returning its data and states
+        in a form that can be pickled and restored in another world"""
+
+        world = self._world
+        subscriptions = world.bus.subscriptions(self._id)
+        # removing the unit stops its walk, writing progress back to its Goto state
+        world.remove_agent(self._id)
+
+        return {
+            "agent_id": self._id,
+            "location": self.location,
+            "speed": self.speed,
+            "color": self.color,
+            "state": self._current_state,
+            "global_state": self._global_state,
+            "previous_state": self._previous_state,
+            "step_debt": self._step_debt,
+            "blackboard": self.blackboard,
+            "subscriptions": subscriptions,
+        }
+
+    @classmethod
+    def restore(cls, world: World, data):
+        """Creates a unit in a world from data returned by export, without entering its state"""
+
+        unit = cls.__new__(cls)
+        StateContext.__init__(unit, data["state"], data["global_state"])
+        unit._previous_state = data["previous_state"]
+        unit._step_debt = data["step_debt"]
+        unit.blackboard = data["blackboard"]
+
+        unit._world = world
+        unit._store = world.units
+        unit._slot = unit._store.add(data["location"], data["speed"], data["color"])
+        unit._store.state_id[unit._slot] = unit._store.intern_state(type(unit.state))
+
+        unit._state_index = world.state_index
+        unit._state_index.add(unit, unit.state)
+        unit._id = world.register_agent(unit, data["agent_id"])
+
+        for message, cell in data["subscriptions"]:
+            world.subscribe(unit._id, message, cell)
+
+        return unit
+
     @property
     def agent_id(self):
         """Returns agent agent_id, immutable"""
         return self._id
 
+    @property
+    def slot(self):
+        """Returns agent slot in the world's unit store, immutable"""
+        return self._slot
+
     @property
     def world(self):
         """Returns agent World, immutable"""
@@ -53,48 +121,108 @@ class Unit(StateContext):
 
     @property
     def x(self):
-        return self._location[0]
+        return int(self._store.position[self._slot, 0])
 
     @x.setter
     def x(self, value):
-        self._location[0] = value
+        self._store.position[self._slot, 0] = value
+        self._world.spatial.move(self, self.location)
 
     @property
     def y(self):
-        return self._location[1]
+        return int(self._store.position[self._slot, 1])
 
     @y.setter
     def y(self, value):
-        self._location[1] = value
+        self._store.position[self._slot, 1] = value
+        self._world.spatial.move(self, self.location)
 
     @property
     def location(self):
         """Returns agent's (X, Y) position in World"""
-        return self.x, self.y
+        return tuple(self._store.position[self._slot].tolist())
 
     @location.setter
     def location(self, location):
-        self.x, self.y = location
+        self._store.position[self._slot] = location
+        self._world.spatial.move(self, location)
+
+    @property
+    def speed(self):
+        return float(self._store.speed[self._slot])
+
+    @speed.setter
+    def speed(self, value):
+        self._store.speed[self._slot] = value
+
+    @property
+    def color(self):
+        return self._store.colors[self._store.color_id[self._slot]]
+
+    @color.setter
+    def color(self, value):
+        self._store.color_id[self._slot] = self._store.intern_color(value)
 
     @property
     def is_walking(self) -> bool:
         return isinstance(self.state, Goto)
 
+def spawn_colony(world: World, count=INIT_UNITS, columns=None):
+    """Spawns a colony of workers and a manager on an open spot in the world,
+    optionally within a (first, end) range of columns,
+    returning the spawn cell and a list of the spawned units"""
+
+    while True:
+        spawn_cell = world.get_random_cell()
+        if columns is not None and not columns[0] < spawn_cell[0] < columns[1] - 1:
+            continue
+        spawn_region = world.graph.neighbours(spawn_cell, False)
+        spawn_region.append(spawn_cell)
+        if all(world.graph.is_free(elem) for elem in spawn_region):
+            break
+
+    units = []
+    for u in range(count - 1):
+        unit = Unit(world, choice(spawn_region), Worker)
+        unit.start()
+        units.append(unit)
+
+    manager = Unit(world, spawn_cell, Manager)
+    manager.start()
+    units.append(manager)
+
+    return spawn_cell, units
+
 class UnitGlobal(State):
-    pass
+    stateless = True
 
 class Goto(State):
     """State used for walking between two points,
-    optionally passing a node list for the agent to follow"""
+    optionally passing a node list for the agent to follow.
+    Entered on every walk, so plain Gotos are taken from and returned to goto_pool"""
 
     revertable = False
 
-    def __init__(self, target, nodes=None, on_arrive=None, on_fail=None):
+    # Set to false if the state has work to do every step while walking
+    sleep_while_walking = True
+
+    def __init__(self, target, nodes=None, on_arrive=None, on_fail=None, reuse_route=False):
+        self.ticket = 0
+        self.reset(target, nodes, on_arrive, on_fail, reuse_route)
+
+    def reset(self, target, nodes=None, on_arrive=None, on_fail=None, reuse_route=False):
+        """Sets the state up for a new walk, turning away path results
+        still on their way for the previous one"""
+
+        self.ticket += 1
         self.on_arrive = on_arrive
         self.on_fail = on_fail
         self.target = target
         self.path = nodes
         self.progress = 0
+        self.version = 0
+        self.streaming = False
+        self.reuse_route = reuse_route
         self.state = PathStates.Idle
 
     @property
@@ -119,7 +247,7 @@ class Goto(State):
         else:
             context.revert_state()
 
-        arrive_msg = Telegram(context.agent_id, None, MessageTypes.MSG_PATH_DONE, context.location)
+        arrive_msg = Telegram(context.agent_id, None, MessageTypes.MSG_PATH_DONE, context.location, context.location)
         context.world.dispatch(arrive_msg)
 
     def on_abort(self, context):
@@ -131,47 +259,91 @@ class Goto(State):
         else:
             context.revert_state()
 
-        arrive_msg = Telegram(context.agent_id, None, MessageTypes.MSG_PATH_FAIL, context.location)
+        arrive_msg = Telegram(context.agent_id, None, MessageTypes.MSG_PATH_FAIL, context.location, context.location)
         context.world.dispatch(arrive_msg)
 
     def enter(self, context):
         if self.path is None:
-            context.world.path(context.location, self.target, on_finish=self.on_path, path_through_fog=False)
+            context.world.path(context.location, self.target, on_finish=self.on_ticket_path, path_through_fog=False,
+                               on_partial=self.on_ticket_partial, reuse=self.reuse_route, args=(self.ticket,))
         else:
             self.target = self.path[-1]
             self.state = PathStates.Working
 
+    def on_ticket_partial(self, ticket, node_list):
+        """Path prefix callback, ignored if the state has been reused since the query"""
+        if ticket == self.ticket:
+            self.on_partial(node_list)
+
+    def on_ticket_path(self, ticket, success, node_list):
+        """Path callback, ignored if the state has been reused since the query"""
+        if ticket == self.ticket:
+            self.on_path(success, node_list)
+
+    def on_partial(self, node_list):
+        """Called with a provisional path prefix, so that walking may begin
+        before the rest of the path has been calculated"""
+
+        self.path = node_list
+        self.streaming = True
+        self.version += 1
+        self.state = PathStates.Working
+
     def on_path(self, success, node_list):
         if success:
-            self.path = node_list
+            if self.streaming:
+                self.path.extend(node_list[1:])
+            else:
+                self.path = node_list
+            self.streaming = False
+            self.version += 1
             self.state = PathStates.Working
         else:
+            self.streaming = False
             self.state = PathStates.Error
 
+    def exit(self, context):
+        context.world.movement.remove(self)
+        if type(self) is Goto:
+            goto_pool.release(self)
+
     def execute(self, context, step):
 
-        # proceed along calculated path, based on step size and context speed
+        # hand new or changed paths to the world, which moves all walking units at once
         if self.state == PathStates.Working:
-            for i in range(ceil(context.speed * step)):
-                cost = context.world.graph.cost(context.location)
-                self.progress += 1 / cost
-                if self.progress < self.length:
-                    context.location = self.path[int(self.progress)]
-                else:
-                    context.location = self.target
-                    self.on_finish(context)
+            if not context.world.movement.is_current(self):
+                context.world.movement.add(context, self)
+
+            # a streamed path may still grow, so keep checking for the remainder
+            if self.sleep_while_walking and not self.streaming:
+                context.sleep()
 
         # abort if pathfinding failed
         elif self.state == PathStates.Error:
             self.on_abort(context)
 
+goto_pool = StatePool(Goto)
+
 class Manager(State):
-    """Unit manager, acting as a AI player; constructing buildings and units"""
+    """Unit manager, acting as a AI player; constructing buildings and units.
+    Requests are queued as they arrive, and handled every few ticks.
+    Outstanding requests are kept in ledgers, so that duplicates are merged"""
+
+    think_interval = THINK_INTERVAL_MANAGER
+
+    def __init__(self):
+        self.requests = deque()
+        self.jobs = {}              # (resource, location) -> fetchers still to assign
+        self.matches = deque()      # (sites, worker matches) found on the path thread
+        self.matching = False
+        self.collections = {}       # (resource, location) -> [target count, set of fetcher ids]
+        self.constructions = set()  # building types requested but not yet built
 
     def enter(self, context):
 
         # make camp where manager stands
         context.world.add_location(context.location, BuildingTypes.Camp)
+        context.world.subscribe(context.agent_id, MessageTypes.MSG_BUILDING_DONE)
 
         # get free workers
         worker_pool = context.world.get_agents_in_state(Worker)
@@ -183,19 +355,38 @@ class Manager(State):
 
         # create initial loggers
         for j in range(INIT_LOGGER):
-            worker_pool[i + j + 1].change_state(Logger())
+            worker_pool[i + j + 1].change_state(Logger.shared())
 
         # create a builder and request a kiln
         worker_pool[-1].change_state(Training(None, TIME_TRAIN_BUILDER, Builder()))
         kiln_msg = Telegram(context.agent_id, worker_pool[-1].agent_id, MessageTypes.MSG_BUILDING_NEEDED, BuildingTypes.Kiln)
         context.world.dispatch(kiln_msg, TIME_TRAIN_BUILDER + 1)
 
+    def execute(self, context, step):
+
+        while self.requests:
+            self.handle_request(context, self.requests.popleft())
+
+        while self.matches:
+            self.assign_jobs(context, *self.matches.popleft())
+
+        if self.jobs and not self.matching:
+            self.match_jobs(context)
+
+        context.sleep()
+
     def request_construction(self, context, building_data):
         """Request a building to be constructed,
         using building data following MSG_BUILDING_NEEDED format"""
 
         builder = context.world.get_agents_in_state(Builder, 1)
 
+        # merge with an outstanding request for the same building
+        if building_data in self.constructions:
+            return
+
+        self.constructions.add(building_data)
+
         # if no builder was found, look for one in training
         if builder is None:
             trainees = context.world.get_agents_in_state(Training)
@@ -219,25 +410,149 @@ class Manager(State):
                 worker.change_state(Training(None, TIME_TRAIN_BUILDER, builder_state))
                 build_msg = Telegram(context.agent_id, worker.agent_id, MessageTypes.MSG_BUILDING_NEEDED, building_data)
                 context.world.dispatch(build_msg, TIME_TRAIN_BUILDER + 1)
+            else:
+                self.constructions.discard(building_data)
         else:
             build_msg = Telegram(context.agent_id, builder.agent_id, MessageTypes.MSG_BUILDING_NEEDED, building_data)
             context.world.dispatch(build_msg)
 
     def request_collection(self, context, count, collection_data):
-        worker_pool = context.world.get_agents_in_state(Worker, count)
-        for worker in worker_pool:
-            worker.change_state(Fetcher(*collection_data))
+        """Request a resource to be collected, using collection data following
+        MSG_RESOURCE_NEEDED format. Merges with any outstanding request for the
+        same resource and location, keeping the larger count"""
+
+        resource, location, target = collection_data
+        key = (resource, location)
+        entry = self.collections.get(key)
+
+        if entry is not None:
+            entry[0] = max(entry[0], target)
+            return
+
+        # workers are assigned together with the other new jobs, once all requests are handled
+        self.collections[key] = [target, set()]
+        self.jobs[key] = count
+
+    def match_jobs(self, context):
+        """Search for the idle workers nearest to the sites still needing them.
+        The search runs on the path thread, so that it cannot stall the game"""
+
+        workers = context.world.get_agents_in_state(Worker, None)
+        sites = {}
+        for key in self.jobs:
+            sites.setdefault(key[1], []).append(key)
+
+        if workers is None:
+            self.drop_unstaffed(sites)
+            return
+
+        self.matching = True
+        context.world.path_match(sites, workers, on_finish=self.on_match, max_cost=JOB_MATCH_MAX_COST, args=(context, sites))
+
+    def on_match(self, context, sites, matches):
+        """Called from the path thread with the workers found, to be assigned in execute"""
+
+        self.matches.append((sites, matches))
+        context.wake()
+
+    def assign_jobs(self, context, sites, matches):
+        """Assign matched workers to the jobs of a search, nearest first. A worker whose
+        nearest site is already staffed is left for the next search, which only runs from
+        the sites still needing workers, so it can be picked up by another site then"""
+
+        self.matching = False
+        idle = Worker.shared()
+        assigned = 0
+
+        for worker, site, cost in matches:
+
+            # the worker may have been given other work since the search
+            if worker.state is not idle:
+                continue
+
+            keys = [key for key in sites[site] if key in self.jobs]
+
+            if len(keys) == 0:
+                continue
+
+            key = keys[0]
+            resource, location = key
+            entry = self.collections.get(key)
+
+            if entry is None:
+                del self.jobs[key]
+                continue
+
+            target, fetchers = entry
+            fetchers.add(worker.agent_id)
+            Fetcher.start(worker, resource, location, target, context.agent_id)
+            assigned += 1
+
+            self.jobs[key] -= 1
+            if self.jobs[key] == 0:
+                del self.jobs[key]
+                if len(self.jobs) == 0:
+                    break
+
+        if assigned == 0:
+            self.drop_unstaffed(sites)
+
+    def drop_unstaffed(self, sites):
+        """Give up the jobs of the sites no worker could be found for, forgetting
+        collections without fetchers, so that they can be requested again"""
+
+        for keys in sites.values():
+            for key in keys:
+                if self.jobs.pop(key, None) is None:
+                    continue
+                entry = self.collections.get(key)
+                if entry is not None and len(entry[1]) == 0:
+                    del self.collections[key]
+
+    def on_fetch_done(self, context, fetcher_id, fetch_data):
+        """Release a fetcher from its collection, closing the collection
+        once all fetchers are done, or reopening it if more is needed since"""
+
+        resource, location = fetch_data
+        entry = self.collections.get((resource, location))
+
+        if entry is None:
+            return
+
+        target, fetchers = entry
+        fetchers.discard(fetcher_id)
+
+        if len(fetchers) == 0:
+            del self.collections[(resource, location)]
+            if context.world.get_resource(location, resource) < target:
+                self.request_collection(context, TARGET_FETCHERS, (resource, location, target))
 
     def on_message(self, context, telegram):
 
+        if telegram.message in (MessageTypes.MSG_BUILDING_NEEDED, MessageTypes.MSG_RESOURCE_NEEDED,
+                                MessageTypes.MSG_BUILDING_DONE, MessageTypes.MSG_BUILDING_FAIL, MessageTypes.MSG_FETCH_DONE):
+            self.requests.append(telegram)
+            return True
+
+        return False
+
+    def handle_request(self, context, telegram):
+
         if telegram.message == MessageTypes.MSG_BUILDING_NEEDED:
             self.request_construction(context, telegram.data)
 
         elif telegram.message == MessageTypes.MSG_RESOURCE_NEEDED:
-            self.request_collection(context, 3, telegram.data)
+            self.request_collection(context, TARGET_FETCHERS, telegram.data)
+
+        elif telegram.message == MessageTypes.MSG_FETCH_DONE:
+            self.on_fetch_done(context, telegram.sender_id, telegram.data)
+
+        elif telegram.message == MessageTypes.MSG_BUILDING_FAIL:
+            self.constructions.discard(telegram.data)
 
         elif telegram.message == MessageTypes.MSG_BUILDING_DONE:
             building, location = telegram.data
+            self.constructions.discard(building)
 
             if building == BuildingTypes.Kiln:
                 worker = context.world.get_agents_in_state(Worker, 1)
@@ -246,7 +561,7 @@ class Manager(State):
                     training_data = (BuildingTypes.Kiln, TIME_TRAIN_KILNER, Kilner(location))
                     worker.change_state(Training(*training_data))
 
-                if len(context.world.get_locations(BuildingTypes.Kiln)) < TARGET_KILN:
+                if context.world.buildings.count(BuildingTypes.Kiln) < TARGET_KILN:
                     next_kiln = Telegram(context.agent_id, telegram.sender_id, MessageTypes.MSG_BUILDING_NEEDED, BuildingTypes.Kiln)
                     context.world.dispatch(next_kiln, randint(0, BUILD_KILN_DELAY))
 
@@ -259,6 +574,8 @@ class Training(State):
         self.location_type = location_type
         self.after_train = after_train
         self.timer = time
+        self.end_time = None
+        self.retry_time = None
 
     def check_building(self, context):
         """If a building is needed, check if one exists and move to it,
@@ -272,12 +589,26 @@ class Training(State):
             build_msg = Telegram(context.agent_id, manager.agent_id, MessageTypes.MSG_BUILDING_NEEDED, self.location_type)
             context.world.dispatch(build_msg)
         else:
-            if context.location == target[0]:
+            if context.location in target:
                 self.begun = True
                 print("Training at {} ({})".format(self.location_type.name, type(self.after_train)))
             else:
-                goto = Goto(target[0], on_arrive=self)
-                context.change_state(goto, False)
+                context.world.path_nearest_of(context.location, target, on_finish=self.on_path, args=(context,))
+
+    def on_path(self, context, success, nodes):
+        """Called when the world pathfinder has found the nearest building"""
+
+        # the unit may have been given another job while the path was searched
+        if context.state is not self:
+            return
+
+        if success:
+            goto = goto_pool.acquire(nodes[-1], nodes, on_arrive=self)
+            context.change_state(goto, False)
+        else:
+            print("Can't reach a {} to train at!".format(self.location_type.name))
+            self.retry_time = context.world.time + 1 + randint(0, MAX_PATH_FAIL_TIME)
+            context.wake()
 
     def enter(self, context):
 
@@ -287,14 +618,35 @@ class Training(State):
             self.begun = True
             print("Training! ({})".format(type(self.after_train)))
         else:
+            context.world.subscribe(context.agent_id, MessageTypes.MSG_BUILDING_DONE)
             self.check_building(context)
 
+    def exit(self, context):
+        if self.location_type is not None:
+            context.world.unsubscribe(context.agent_id, MessageTypes.MSG_BUILDING_DONE)
+
     def execute(self, context, step):
 
-        if self.begun:
-            self.timer -= step
-            if self.timer <= 0:
-                context.change_state(self.after_train)
+        if not self.begun:
+            time = context.world.time
+
+            # look for a reachable building again after a failed path
+            if self.retry_time is None:
+                context.sleep()
+            elif time >= self.retry_time:
+                self.retry_time = None
+                self.check_building(context)
+            else:
+                context.sleep(self.retry_time - time)
+            return
+
+        if self.end_time is None:
+            self.end_time = context.world.time + self.timer
+
+        if context.world.time >= self.end_time:
+            context.change_state(self.after_train)
+        else:
+            context.sleep(self.end_time - context.world.time)
 
     def on_message(self, context, telegram):
 
@@ -349,12 +701,27 @@ class Builder(State):
         """Stake out a build site near the camp (or builder if none exists),
         move to it, and set the building variable correctly"""
 
-        camp_location = context.world.get_locations(BuildingTypes.Camp)
-        build_origin = camp_location[0] if camp_location is not None else context.location
+        camp_location = context.world.get_nearest_location(BuildingTypes.Camp, context.location)
+        build_origin = camp_location if camp_location is not None else context.location
         build_site = context.world.get_random_cell(build_origin, BUILD_CAMP_RANGE)
+
+        if build_site is None:
+            build_site = context.world.get_random_cell(build_origin, None)
+
+        # with nowhere to build, drop the request so that the manager can make it again
+        if build_site is None:
+            print("Nowhere to build a {}!".format(building_data.name))
+            self.building = None
+            mgr = context.world.get_agents_in_state(Manager, 1)
+            if mgr is not None:
+                fail_msg = Telegram(context.agent_id, mgr.agent_id, MessageTypes.MSG_BUILDING_FAIL, building_data)
+                context.world.dispatch(fail_msg)
+            return
+
         context.world.reveal(build_site)
         context.world.add_location(build_site, BuildingTypes.Buildsite)
-        goto = Goto(build_site, on_arrive=self)
+        context.world.subscribe(context.agent_id, MessageTypes.MSG_RESOURCE_CHANGE, build_site)
+        goto = goto_pool.acquire(build_site, on_arrive=self)
         context.change_state(goto)
         self.building = building_data
 
@@ -363,17 +730,22 @@ class Builder(State):
         Also sends a broadcast with information about the new building"""
 
         context.world.add_location(context.location, self.building)
-        done_msg = Telegram(context.agent_id, None, MessageTypes.MSG_BUILDING_DONE, data=(self.building, context.location))
+        done_msg = Telegram(context.agent_id, None, MessageTypes.MSG_BUILDING_DONE, data=(self.building, context.location), cell=context.location)
         context.world.dispatch(done_msg)
+        context.world.unsubscribe(context.agent_id, MessageTypes.MSG_RESOURCE_CHANGE, context.location)
         self.building = None
         self.has_begun = False
         t = context.world.get_random_cell(context.location, 2)
-        context.change_state(Goto(t, on_arrive=self))
+        if t is not None:
+            context.change_state(goto_pool.acquire(t, on_arrive=self))
 
     def enter(self, context):
         context.color = COL_BUILDER
         self.check_requirements(context)
 
+    def execute(self, context, step):
+        context.sleep()
+
     def on_message(self, context, telegram):
 
         if telegram.message == MessageTypes.MSG_BUILDING_NEEDED:
@@ -394,15 +766,22 @@ class Builder(State):
         return False
 
 class Worker(State):
-    """An idle worker, ready to respond to commands from manager"""
+    """An idle worker, ready to respond to commands from manager.
+    Jobs end here, so the blackboard is cleared for the next one"""
+
+    stateless = True
 
     def enter(self, context):
         context.color = COL_UNIT
+        context.blackboard.clear()
+
+    def execute(self, context, step):
+        context.sleep()
 
     def on_message(self, context, telegram):
 
         if telegram.message == MessageTypes.MSG_RESOURCE_NEEDED:
-            context.change_state(Fetcher(*telegram.data))
+            Fetcher.start(context, *telegram.data)
             return True
 
         elif telegram.message == MessageTypes.MSG_CHANGE_STATE:
@@ -414,51 +793,76 @@ class Worker(State):
 
 class Logger(State):
     """A lumberjack, chopping down any nearby trees and leaving logs
-    on the ground"""
+    on the ground. Shared by all loggers, keeping its timers on the blackboard"""
 
-    def __init__(self):
-        self.state = Actions.Idle
-        self.timer = 0
+    stateless = True
 
     def enter(self, context):
         context.color = COL_LOGGER
-        if self.state == Actions.Walking:
-            self.state = Actions.Working
-            self.timer = TIME_CHOP_TREE
+        board = context.blackboard
+        if board.setdefault("action", Actions.Idle) == Actions.Walking:
+            board["action"] = Actions.Working
+            board["end_time"] = context.world.time + TIME_CHOP_TREE
 
     def on_path(self, context, success, nodes):
         """Called when the world pathfinder has finished calculating a path"""
 
+        # the unit may have been given another job while the path was searched
+        if context.state is not self:
+            return
+
         if success:
-            self.state = Actions.Walking
-            goto = Goto(nodes[-1], on_arrive=self)
+            context.blackboard["action"] = Actions.Walking
+            goto = goto_pool.acquire(nodes[-1], on_arrive=self)
             context.change_state(goto)
         else:
-            self.state = Actions.Idle
+            context.blackboard["action"] = Actions.Idle
+            context.wake()
 
     def execute(self, context, step):
 
-        if self.state == Actions.Working:
-            self.timer -= step
+        time = context.world.time
+        board = context.blackboard
+        action = board["action"]
 
-            if self.timer <= 0:
+        if action == Actions.Working:
+            if time >= board["end_time"]:
                 context.world.graph.set_tile(context.location, TerrainTypes.Stump, 1)
                 context.world.add_resource(context.location, ResourceTypes.Log)
-                self.state = Actions.Idle
-                self.timer = TIME_CHOP_TREE
-        elif self.state == Actions.Idle and randint(0, MAX_PATH_WAIT_RANDOM) == 1:
-            self.state = Actions.Waiting
-            finish = lambda a, b: self.on_path(context, a, b)
-            context.world.path_nearest_terrain(context.location, TerrainTypes.Tree, on_finish=finish)
+                board["action"] = Actions.Idle
+            else:
+                context.sleep(board["end_time"] - time)
+
+        elif action == Actions.Idle:
+            # idle for as many steps as a 1 in MAX_PATH_WAIT_RANDOM roll each step would take on average
+            wait_time = board.get("wait_time")
+            if wait_time is None:
+                wait_time = board["wait_time"] = time + randint(1, 2 * MAX_PATH_WAIT_RANDOM + 1) * step
+
+            if time >= wait_time:
+                board["wait_time"] = None
+                board["action"] = Actions.Waiting
+                context.world.path_nearest_terrain(context.location, TerrainTypes.Tree, on_finish=self.on_path, args=(context,))
+            else:
+                context.sleep(wait_time - time)
+
+        else:
+            context.sleep()
 
     def on_message(self, context, telegram):
         return False
 
 class Transporter(State):
     """A unit that transports a number of resources from one tile to
-    another"""
+    another, reusing its routes between the two for each trip.
+    Taken from and returned to transporter_pool"""
 
     def __init__(self, from_tile, to_tile, resource=None, count=1, on_finish=None):
+        self.reset(from_tile, to_tile, resource, count, on_finish)
+
+    def reset(self, from_tile, to_tile, resource=None, count=1, on_finish=None):
+        """Sets the state up for a new transport"""
+
         self.resource = resource
         self.from_tile = from_tile
         self.to_tile = to_tile
@@ -466,6 +870,12 @@ class Transporter(State):
         self.is_carrying = False
         self.on_finish = on_finish
 
+    def finish(self, context):
+        """Hand the unit over to the state following the transport, and return to the pool"""
+
+        context.change_state(self.on_finish if self.on_finish is not None else Worker.shared())
+        transporter_pool.release(self)
+
     def enter(self, context):
 
         if self.is_carrying and context.location == self.to_tile:
@@ -473,65 +883,113 @@ class Transporter(State):
             self.is_carrying = False
             count = context.world.add_resource(context.location, self.resource)
 
-            msg_res = Telegram(context.agent_id, None, MessageTypes.MSG_RESOURCE_CHANGE, data=(self.resource, self.to_tile, count))
+            msg_res = Telegram(context.agent_id, None, MessageTypes.MSG_RESOURCE_CHANGE, data=(self.resource, self.to_tile, count), cell=self.to_tile)
             context.world.dispatch(msg_res)
 
             if count < self.count:
-                goto = Goto(self.from_tile, on_arrive=self)
+                goto = goto_pool.acquire(self.from_tile, on_arrive=self, reuse_route=True)
                 context.change_state(goto)
             else:
-                state = self.on_finish if self.on_finish is not None else Worker()
-                context.change_state(state)
+                self.finish(context)
 
         elif context.location == self.from_tile:
             # Grab item to carry
             if context.world.get_resource(context.location, self.resource) > 0:
                 context.world.add_resource(context.location, self.resource, -1)
                 self.is_carrying = True
-                goto = Goto(self.to_tile, on_arrive=self)
+                goto = goto_pool.acquire(self.to_tile, on_arrive=self, reuse_route=True)
                 context.change_state(goto)
             else:
-                state = self.on_finish if self.on_finish is not None else Worker()
-                context.change_state(state)
+                self.finish(context)
         else:
             # Goto pickup site for items
-            goto = Goto(self.from_tile, on_arrive=self)
+            goto = goto_pool.acquire(self.from_tile, on_arrive=self, reuse_route=True)
             context.change_state(goto)
 
+    def execute(self, context, step):
+        context.sleep()
+
+transporter_pool = StatePool(Transporter)
+
 class Fetcher(State):
     """A unit that sets out to collect a specific resource
-    to a specified tile"""
+    to a specified tile. Shared by all fetchers, keeping the job on the blackboard"""
 
-    def __init__(self, resource, location, count=None):
-        self.resource = resource
-        self.location = location
-        self.count = count
-        self.state = Actions.Idle
-        self.fail_timer = randint(0, 5)
+    stateless = True
+
+    @classmethod
+    def start(cls, context, resource, location, count=None, manager_id=None):
+        """Puts a unit to work fetching a resource to a location,
+        reporting back to the manager that gave the job, if any"""
+
+        board = context.blackboard
+        board["job"] = (resource, location, count)
+        board["manager"] = manager_id
+        board["action"] = Actions.Idle
+        board["retry_time"] = None
+        context.change_state(cls.shared())
 
     def enter(self, context):
         context.color = COL_FETCHER
-        if self.state == Actions.Working:
-            self.state = Actions.Idle
+        board = context.blackboard
+        if board["retry_time"] is None:
+            board["retry_time"] = context.world.time + randint(0, 5)
+        if board["action"] == Actions.Working:
+            board["action"] = Actions.Idle
+            resource, location, count = board["job"]
+            if count is not None and context.world.get_resource(location, resource) >= count:
+                self.finish(context)
+
+    def finish(self, context):
+        """Report the collection as done to the manager, and return to being a worker"""
+
+        # report to the manager keeping the ledger for this job, wherever the unit is now
+        manager_id = context.blackboard["manager"]
+
+        if manager_id is None:
+            mgr = context.world.get_agents_in_state(Manager, 1)
+            manager_id = mgr.agent_id if mgr is not None else None
+
+        if manager_id is not None:
+            resource, location, _ = context.blackboard["job"]
+            done_msg = Telegram(context.agent_id, manager_id, MessageTypes.MSG_FETCH_DONE, data=(resource, location))
+            context.world.dispatch(done_msg)
+
+        context.change_state(Worker.shared())
 
     def on_path(self, context, success, nodes):
 
+        # the unit may have been given another job while the path was searched
+        if context.state is not self:
+            return
+
+        board = context.blackboard
+
         if success:
-            self.state = Actions.Working
-            trans = Transporter(nodes[-1], self.location, self.resource, self.count, on_finish=self)
+            board["action"] = Actions.Working
+            resource, location, count = board["job"]
+            trans = transporter_pool.acquire(nodes[-1], location, resource, count, on_finish=self)
             context.change_state(trans)
         else:
-            self.state = Actions.Idle
-            self.fail_timer = 1 + randint(0, MAX_PATH_FAIL_TIME)
+            board["action"] = Actions.Idle
+            board["retry_time"] = context.world.time + 1 + randint(0, MAX_PATH_FAIL_TIME)
+            context.wake()
 
     def execute(self, context, step):
 
-        self.fail_timer -= step
-        if self.state == Actions.Idle and self.fail_timer <= 0:
-            self.state = Actions.Waiting
-            finish = lambda a, b: self.on_path(context, a, b)
-            path_data = (context.location, self.resource)
-            context.world.path_nearest_resource(*path_data, on_finish=finish, exclude=context.world.buildings)
+        time = context.world.time
+        board = context.blackboard
+        action = board["action"]
+
+        if action == Actions.Idle and time >= board["retry_time"]:
+            board["action"] = Actions.Waiting
+            resource = board["job"][0]
+            context.world.path_nearest_resource(context.location, resource, on_finish=self.on_path,
+                                                exclude=context.world.buildings, args=(context,))
+        elif action == Actions.Idle:
+            context.sleep(board["retry_time"] - time)
+        else:
+            context.sleep()
 
     def on_message(self, context, telegram):
         return False
@@ -541,11 +999,16 @@ class Scout(Goto):
     in random directions, gradually venturing further out"""
 
     expeditions = 1
+    sleep_while_walking = False
+    think_interval = THINK_INTERVAL_SCOUT
 
     def __init__(self):
         super().__init__(None)
-        self.fail_timer = randint(0, 5)
+        self.retry_delay = randint(0, 5)
+        self.retry_time = None
+        self.revealed = 0
         self.home = None
+        self.manager_id = None
 
     def enter(self, context):
 
@@ -557,13 +1020,47 @@ class Scout(Goto):
         """ Gets a random cell a distance away from the unit's home,
         and requests a path to it from the world pathfinder"""
 
-        origin = context.world.get_locations(BuildingTypes.Camp)
-        origin = origin[0] if origin is not None else context.location
+        origin = context.world.get_nearest_location(BuildingTypes.Camp, context.location)
+        origin = origin if origin is not None else context.location
 
         self.target = context.world.get_random_cell(origin, UNIT_SCOUT_RANGE + Scout.expeditions // 2)
-        context.world.path(context.location, self.target, on_finish=self.on_path, path_through_fog=True)
+
+        if self.target is None:
+            self.on_path(False, [])
+            return
+
+        context.world.path(context.location, self.target, on_finish=self.on_path, path_through_fog=True, budget=PATH_SCOUT_BUDGET)
+
+    def reveal_walked(self, context, index):
+        """Reveals fog around the path cells walked since the last call,
+        up to a path index, reporting any trees found to the manager
+        in one message, holding a list of cells per terrain type"""
+
+        world = context.world
+
+        # the manager never changes, so look it up once
+        if self.manager_id is None:
+            manager = world.get_agents_in_state(Manager, 1)
+            if manager is None:
+                return
+            self.manager_id = manager.agent_id
+
+        found = {}
+
+        for node in self.path[self.revealed:index + 1]:
+            for cell in world.reveal(node):
+                terrain = world.graph.get_terrain(cell)
+                if terrain is TerrainTypes.Tree:
+                    found.setdefault(terrain, []).append(cell)
+
+        self.revealed = max(self.revealed, index + 1)
+
+        if found:
+            res_msg = Telegram(context.agent_id, self.manager_id, MessageTypes.MSG_RESOURCE_FOUND, data=found)
+            world.dispatch(res_msg)
 
     def on_finish(self, context):
+        self.reveal_walked(context, len(self.path) - 1)
         self.state = PathStates.Idle
         Scout.expeditions += 1
 
@@ -574,34 +1071,37 @@ class Scout(Goto):
 
         if success:
             self.progress = 0
+            self.revealed = 0
             self.path = node_list
+            self.target = node_list[-1]
+            self.version += 1
             self.state = PathStates.Working
         else:
             self.state = PathStates.Idle
-            self.fail_timer = 60 + randint(0, 120)
+            self.retry_delay = 60 + randint(0, 120)
 
     def execute(self, context, step):
 
-        self.fail_timer -= step
+        time = context.world.time
+
+        # delays are set from path callbacks, so start counting them here
+        if self.retry_delay is not None:
+            self.retry_time = time + self.retry_delay
+            self.retry_delay = None
 
-        if self.state == PathStates.Idle and self.fail_timer <= 0:
-            self.state = PathStates.Waiting
-            self.get_random_path(context)
+        if self.state == PathStates.Idle:
+            if time >= self.retry_time:
+                self.state = PathStates.Waiting
+                self.get_random_path(context)
+            else:
+                context.sleep(self.retry_time - time)
 
         elif self.state == PathStates.Working:
             super().execute(context, step)
 
-            world = context.world
-            mgr = world.get_agents_in_state(Manager, 1)
-
-            if mgr is None:
-                return
-
-            for cell in world.reveal(context.location):
-                if world.graph.get_terrain(cell) is TerrainTypes.Tree:
-                    res_data = (TerrainTypes.Tree, cell)
-                    res_msg = Telegram(context.agent_id, mgr.agent_id, MessageTypes.MSG_RESOURCE_FOUND, data=res_data)
-                    world.dispatch(res_msg)
+            # scouts think less often than they move, so reveal every cell walked since last time
+            index = min(int(context.world.movement.progress(self)), self.length - 1)
+            self.reveal_walked(context, index)
 
 class ScoutBehind(Scout):
     """A unit that stays behind at the camp, gradually
@@ -609,10 +1109,10 @@ class ScoutBehind(Scout):
 
     def __init__(self):
         super().__init__()
-        self.fail_timer = randint(0, 5)
+        self.retry_delay = randint(0, 5)
 
     def get_random_path(self, context):
-        camp = context.world.get_locations(BuildingTypes.Camp)[0]
+        camp = context.world.get_nearest_location(BuildingTypes.Camp, context.location)
         context.world.path_nearest_fog(camp, on_finish=self.on_path)
 
     def on_path(self, success, node_list):
@@ -629,10 +1129,12 @@ class ScoutBehind(Scout):
         elif self.state == PathStates.Searching:
             if success:
                 self.progress = 0
+                self.revealed = 0
                 self.target = node_list[-1]
+                self.version += 1
                 self.state = PathStates.Working
             else:
-                self.fail_timer = 1 + randint(0, 5)
+                self.retry_delay = 1 + randint(0, 5)
                 self.state = PathStates.Idle
 
 
@@ -642,7 +1144,7 @@ class ScoutBehind(Scout):
         if self.state == PathStates.Error:
             context.change_state(Scout())
         elif self.state == PathStates.Searching:
-            context.world.path(context.location, self.path[-1], on_finish=self.on_path, path_through_fog=True)
+            context.world.path(context.location, self.path[-1], on_finish=self.on_path, path_through_fog=True, budget=PATH_SCOUT_BUDGET)
 
 class Kilner(State):
     """A unit that operates a kiln, producing charcoal"""
@@ -650,14 +1152,15 @@ class Kilner(State):
     def __init__(self, kiln_site):
         self.location = kiln_site
         self.state = Actions.Idle
-        self.timer = 0
+        self.end_time = None
 
     def enter(self, context):
         context.color = COL_KILNER
+        context.world.subscribe(context.agent_id, MessageTypes.MSG_RESOURCE_CHANGE, self.location)
         if context.location == self.location:
             self.state = Actions.Idle
         else:
-            context.change_state(Goto(self.location, on_arrive=self))
+            context.change_state(goto_pool.acquire(self.location, on_arrive=self))
 
     def execute(self, context, step):
 
@@ -667,7 +1170,7 @@ class Kilner(State):
 
             if count >= COAL_PRODUCE_LOGS:
                 context.world.add_resource(context.location, ResourceTypes.Log, -COAL_PRODUCE_LOGS)
-                self.timer = TIME_PRODUCE_COAL
+                self.end_time = context.world.time + TIME_PRODUCE_COAL
                 self.state = Actions.Working
             else:
                 self.state = Actions.Waiting
@@ -679,10 +1182,14 @@ class Kilner(State):
                     context.world.dispatch(res_msg)
 
         elif self.state == Actions.Working:
-            self.timer -= step
-            if self.timer <= 0:
+            if context.world.time >= self.end_time:
                 context.world.add_resource(context.location, ResourceTypes.Coal)
-                self.state = Actions.Waiting
+                self.state = Actions.Idle
+            else:
+                context.sleep(self.end_time - context.world.time)
+
+        else:
+            context.sleep()
 
     def on_message(self, context, telegram):
 
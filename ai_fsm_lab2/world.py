@@ -1,15 +1,23 @@
 """ Represent a 2D world with agents and locations """
 
 import threading
-from collections import defaultdict
+import timeit
+import traceback
+from collections import deque
 from queue import Queue
 from copy import deepcopy
 from enum import Enum, auto
+from functools import partial
 from random import randint
 
 from config import *
-from path import Path, WeightedGrid
-from telegram import Telegram
+from movement import MovementSystem
+from path import Path, RouteCache, WeightedGrid
+from spatial import BuildingRegistry, FreeCellSampler, ResourceIndex, SpatialHash
+from state import StateIndex
+from store import UnitStore
+from telegram import MessageBus, Telegram
+from timer import TimerQueue
 
 
 class TerrainTypes(Enum):
@@ -38,6 +46,10 @@ class PathMode(Enum):
     """Represents pathfinding modes"""
     AStar       = auto()
     Dijkstra    = auto()
+    Stream      = auto()
+    Partial     = auto()
+    Multi       = auto()
+    Match       = auto()
 
 class WorldGrid(WeightedGrid):
 
@@ -75,6 +87,7 @@ class WorldGrid(WeightedGrid):
         t[0] = terrain
         if weight is not None:
             t[1] = weight
+        self.touch(cell)
 
         for event in self.on_terrain_changed:
             event(cell, terrain)
@@ -113,6 +126,11 @@ def load_map(filename):
 
     lines = file.readlines()
     file.close()
+    return parse_map(lines)
+
+def parse_map(lines):
+    """Build a world grid from the lines of a map"""
+
     height = len(lines)
 
     if height == 0:
@@ -147,18 +165,31 @@ class World:
     _next_id = 0        # Static ID counter
 
     def __init__(self, grid):
-        self._messages = []
+        self._timers = TimerQueue()
+        self.bus = MessageBus()
         self._time = 0
+        self._tick = 0
         self._graph = grid
         self.agents = {}
-        self.buildings = {}
-        self.resources = defaultdict(lambda: defaultdict(int))
+        self._active = {}           # agents updated each step, in order of waking
+        self._woken = deque()       # agents to wake at the next step, appended from any thread
+        self._wakeups = TimerQueue()
+        self._wake_handles = {}
+        self.units = UnitStore()
+        self.state_index = StateIndex()
+        self.spatial = SpatialHash(SPATIAL_BUCKET_SIZE)
+        self.buildings = BuildingRegistry()
+        self.free_cells = FreeCellSampler(grid, self.buildings, SPATIAL_BUCKET_SIZE)
+        self.resources = ResourceIndex(SPATIAL_BUCKET_SIZE)
+        self.movement = MovementSystem(grid, self.units, self.spatial)
+        self.routes = RouteCache(grid, PATH_ROUTE_CACHE)
 
         self.path_queue = Queue()
-        self.path_thread = threading.Thread(target=self.do_path)
+        self.path_latency = deque(maxlen=PATH_LATENCY_SAMPLES)
+        self.messages_sent = 0
+        self.path_thread = threading.Thread(target=self.do_path, daemon=True)
         self.path_thread.start()
 
-        self.on_buildings_changed = []
         self.on_resources_changed = []
 
     @classmethod
@@ -166,6 +197,15 @@ class World:
         grid = load_map(filename)
         return cls(grid)
 
+    @classmethod
+    def from_lines(cls, lines):
+        grid = parse_map(lines)
+        return cls(grid)
+
+    @property
+    def time(self):
+        return self._time
+
     @property
     def width(self) -> int:
         return self._graph.width
@@ -182,28 +222,61 @@ class World:
     def all_agents(self):
         return self.agents.values()
 
+    @property
+    def active_count(self) -> int:
+        return len(self._active)
+
     def _id_is_free(self, agent_id: int) -> bool:
         """Internal - check if ID is free"""
         return agent_id not in self.agents
 
     def _dispatch_delayed(self):
         """Internal - dispatch all due messages in queue"""
-        for message in self._messages:
-            if self._time >= message.dispatch_time:
-                self.dispatch(message)
-                self._messages.remove(message)
-
-    def register_agent(self, agent) -> int:
-        """Register an agent and call initializer, returning agent's assigned ID"""
-        self.agents[self._next_id] = agent
-        self._next_id += 1
+        for message in self._timers.pop_due(self._time):
+            self.dispatch(message)
+
+    def _wake_pending(self):
+        """Internal - activate agents whose sleep ran out or who were woken since the last step"""
+
+        for agent in self._wakeups.pop_due(self._time):
+            self._wake_handles.pop(agent, None)
+            self._active[agent] = None
+
+        while self._woken:
+            agent = self._woken.popleft()
+            handle = self._wake_handles.pop(agent, None)
+            if handle is not None:
+                handle.cancel()
+            if agent.agent_id in self.agents:
+                self._active[agent] = None
+
+    def register_agent(self, agent, agent_id=None) -> int:
+        """Register an agent and call initializer, returning agent's assigned ID.
+        Agents moved in from another world keep the ID they were given there"""
+
+        if agent_id is None:
+            agent_id = self._next_id
+            self._next_id += 1
+
+        self.agents[agent_id] = agent
+        self._active[agent] = None
+        self.spatial.move(agent, agent.location)
         agent.init()
-        return self._next_id - 1
+        return agent_id
 
     def remove_agent(self, agent_id: int):
         """Remove an agent from the dictionary"""
         if agent_id in self.agents:
-            self.agents.pop(agent_id)
+            agent = self.agents.pop(agent_id)
+            self._active.pop(agent, None)
+            handle = self._wake_handles.pop(agent, None)
+            if handle is not None:
+                handle.cancel()
+            self.state_index.remove(agent, agent.state)
+            self.spatial.remove(agent)
+            self.movement.remove(agent.state)
+            self.units.remove(agent.slot)
+            self.bus.unsubscribe(agent_id)
 
     def get_agent(self, agent_id):
         """Returns an agent when provided with valid ID"""
@@ -219,82 +292,231 @@ class World:
         return agents
 
     def get_agents_in_state(self, state, count=None):
-        """Returns a list of agents in a particular state (or substate)"""
+        """Returns a list of agents in a particular state (or substate),
+        or the first one found if count is 1"""
 
-        agents = list(filter(lambda L: isinstance(L.state, state), self.all_agents))
+        agents = self.state_index.get(state, count)
 
         if len(agents) == 0:
             return None
         if count == 1:
             return agents[0]
-        if count is None:
-            return agents
 
-        return agents[:min(count, len(agents))]
+        return agents
 
-    def get_random_cell(self, origin=None, radius=10):
-        """Gets a random cell in the world, or around a specific point"""
+    def get_agents_at(self, cell):
+        """Returns a list of all agents standing on a cell"""
+        return self.spatial.at(cell)
 
-        while True:
-            if origin is None:
-                cell = (randint(0, self.width - 1), randint(0, self.height - 1))
-            else:
-                o_x, o_y = origin
-                cell = (o_x + randint(-radius, radius), o_y + randint(-radius, radius))
+    def get_agents_near(self, cell, radius):
+        """Returns a list of all agents within a square radius around a cell"""
+        return self.spatial.near(cell, radius)
 
-            if self.graph.is_in_bounds(cell) and self.graph.is_free(cell) and cell not in self.buildings:
-                return cell
+    def get_random_cell(self, origin=None, radius=10, reachable=True):
+        """Gets a random free cell without buildings in the world, or around a specific point,
+        optionally only cells reachable from it. Returns None if no such cell exists"""
+        return self.free_cells.sample(origin, radius, reachable)
 
     def do_path(self):
-        """Runs in a separate thread to handle path queries from game agents"""
+        """Runs in a separate thread to handle path queries from game agents.
+        A query whose search or callback raises is reported and skipped,
+        so that the thread keeps serving, and wait_for_paths cannot hang"""
 
         while True:
-            query = self.path_queue.get(block=True)
+            queued, query = self.path_queue.get(block=True)
+
+            try:
+                self._run_path_query(query)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.path_latency.append(timeit.default_timer() - queued)
+                self.path_queue.task_done()
+
+    def _run_path_query(self, query):
+        """Internal - run the search of a path query, along with its callback"""
+
+        fog_filter = None if query[4] else lambda cell: not self.graph.get_fog(cell)
+
+        if query[0] == PathMode.AStar and self.path_queue.qsize() >= PATH_ANYTIME_LOAD:
+            # under load, trade optimality for throughput
+            deadline = timeit.default_timer() + PATH_ANYTIME_TIME
+            Path.ara_star_proxy(self.graph, query[1], query[2], query[3], PATH_ANYTIME_MULT, PATH_ANYTIME_STEP, deadline,
+                                filter_func=fog_filter, heuristic=Path.diagonal)
+        elif query[0] == PathMode.AStar:
+            Path.a_star_proxy(self.graph, query[1], query[2], query[3], filter_func=fog_filter, heuristic=Path.diagonal)
+        elif query[0] == PathMode.Partial:
+            Path.a_star_partial_proxy(self.graph, query[1], query[2], query[3], query[5], query[6],
+                                      filter_func=fog_filter, heuristic=Path.diagonal)
+        elif query[0] == PathMode.Stream:
+            Path.a_star_stream(self.graph, query[1], query[2], query[5], query[3], PATH_STREAM_PREFIX, PATH_STREAM_BUDGET,
+                               filter_func=fog_filter, heuristic=Path.diagonal)
+        elif query[0] == PathMode.Multi:
+            Path.a_star_multi_proxy(self.graph, query[1], query[2], query[3], filter_func=fog_filter, heuristic=Path.diagonal)
+        elif query[0] == PathMode.Dijkstra:
+            Path.dijkstras_proxy(self.graph, query[1], query[2], query[3], filter_func=fog_filter)
+        elif query[0] == PathMode.Match:
+            query[3](list(self._match_search(query[1], query[2], query[4], query[5])))
+
+    def wait_for_paths(self):
+        """Blocks until every queued path query has been answered"""
+        self.path_queue.join()
+
+    def _queue_path(self, query):
+        """Internal - queue a path query for the path thread, stamped with the time it was queued"""
+        self.path_queue.put((timeit.default_timer(), query))
+
+    def path(self, path_from, path_to, on_finish, path_through_fog=False, on_partial=None, budget=None, deadline=None, reuse=False, args=()):
+        """Calculates an A* path and runs on_finish with the path data.
+        If on_partial is provided, long paths are streamed; a provisional prefix
+        is sent to on_partial, and the remainder (starting at its last node) to on_finish.
+        If an expansion budget or a deadline (in seconds) is provided, the search is bounded,
+        and if the target is not reached, on_finish gets a path towards it instead,
+        which can be told apart by its last node.
+        With reuse, a cached route that is still valid is passed to on_finish straight away,
+        and newly found routes are cached; such paths are never streamed.
+        Any args are passed to the callbacks ahead of the path data"""
+
+        if args:
+            on_finish = partial(on_finish, *args)
+            if on_partial is not None:
+                on_partial = partial(on_partial, *args)
+
+        if reuse:
+            route = self.routes.get(path_from, path_to)
+
+            if route is not None:
+                on_finish(True, route)
+                return
+
+            version = self.graph.version
+
+            def on_route(success, node_list):
+                if success:
+                    self.routes.put(node_list, version)
+                on_finish(success, node_list)
+
+            query = (PathMode.AStar, path_from, path_to, on_route, path_through_fog)
+        elif budget is not None or deadline is not None:
+            if deadline is not None:
+                deadline += timeit.default_timer()
+            query = (PathMode.Partial, path_from, path_to, on_finish, path_through_fog, budget, deadline)
+        elif on_partial is not None and Path.diagonal(path_from, path_to) >= PATH_STREAM_MIN_DIST:
+            query = (PathMode.Stream, path_from, path_to, on_finish, path_through_fog, on_partial)
+        else:
+            query = (PathMode.AStar, path_from, path_to, on_finish, path_through_fog)
 
-            fog_filter = None if query[4] else lambda cell: not self.graph.get_fog(cell)
+        self._queue_path(query)
 
-            if query[0] == PathMode.AStar:
-                Path.a_star_proxy(self.graph, query[1], query[2], query[3], filter_func=fog_filter, heuristic=Path.diagonal)
-            elif query[0] == PathMode.Dijkstra:
-                Path.dijkstras_proxy(self.graph, query[1], query[2], query[3], filter_func=fog_filter)
+    def path_nearest_of(self, path_from, cells, on_finish, path_through_fog=False, args=()):
+        """Calculates an A* path to the nearest of several cells,
+        and runs on_finish with any args and the path data"""
 
-    def path(self, path_from, path_to, on_finish, path_through_fog=False):
-        """Calculates an A* path and runs on_finish with the path data"""
+        if args:
+            on_finish = partial(on_finish, *args)
 
-        query = (PathMode.AStar, path_from, path_to, on_finish, path_through_fog)
-        self.path_queue.put(query)
+        query = (PathMode.Multi, path_from, cells, on_finish, path_through_fog)
+        self._queue_path(query)
 
-    def path_nearest_resource(self, path_from, item_type, on_finish, path_through_fog=False, exclude=None):
+    def path_nearest_resource(self, path_from, item_type, on_finish, path_through_fog=False, exclude=None, args=()):
         """Calculates an path to the nearest resource of a specific type,
-         and runs on_finish with the path data"""
+         and runs on_finish with any args and the path data.
+         The piles nearest in a straight line are tried first, and if none of them
+         can be reached, the search falls back to the nearest reachable pile"""
 
-        if exclude is None:
-            exclude = []
+        if args:
+            on_finish = partial(on_finish, *args)
 
-        if item_type not in self.resources:
+        piles = self.resources.nearest(item_type, path_from, PATH_RESOURCE_CANDIDATES, exclude)
+
+        if len(piles) == 0:
             on_finish(False, None)
+            return
 
-        goal = lambda cell: self.get_resource(cell, item_type) > 0 and cell not in exclude
-        query = (PathMode.Dijkstra, path_from, goal, on_finish, path_through_fog)
-        self.path_queue.put(query)
+        if len(piles) < PATH_RESOURCE_CANDIDATES:
+            # every pile was a candidate, so there is nothing else to fall back to
+            query = (PathMode.Multi, path_from, piles, on_finish, path_through_fog)
+            self._queue_path(query)
+            return
+
+        if exclude is None:
+            exclude = ()
+
+        goal = lambda cell: self.resources.get(cell, item_type) > 0 and cell not in exclude
+
+        def on_candidates(success, node_list):
+            if success:
+                on_finish(success, node_list)
+            else:
+                self._queue_path((PathMode.Dijkstra, path_from, goal, on_finish, path_through_fog))
+
+        query = (PathMode.Multi, path_from, piles, on_candidates, path_through_fog)
+        self._queue_path(query)
 
-    def path_nearest_terrain(self, path_from, terrain_type, on_finish, path_through_fog=False, exclude=None):
+    def path_nearest_terrain(self, path_from, terrain_type, on_finish, path_through_fog=False, exclude=None, args=()):
         """Calculates an path to the nearest block of a specific terrain type,
-         and runs on_finish with the path data"""
+         and runs on_finish with any args and the path data"""
+
+        if args:
+            on_finish = partial(on_finish, *args)
 
         if exclude is None:
             exclude = []
 
         goal = lambda cell: self.graph.get_terrain(cell) == terrain_type and cell not in exclude
         query = (PathMode.Dijkstra, path_from, goal, on_finish, path_through_fog)
-        self.path_queue.put(query)
+        self._queue_path(query)
 
     def path_nearest_fog(self, path_from, on_finish):
         """Calculates an path to the nearest block with fog-of-war,
          and runs on_finish with the path data"""
 
         query = (PathMode.Dijkstra, path_from, self.graph.get_fog, on_finish, None)
-        self.path_queue.put(query)
+        self._queue_path(query)
+
+    def _match_cells(self, sites, agents):
+        """Internal - group agents by cell, leaving out agents walled off from every site,
+        so that they cannot make a match search flood the whole map"""
+
+        components = {self.free_cells.component(site) for site in sites}
+
+        by_cell = {}
+        for agent in agents:
+            location = agent.location
+            if self.free_cells.component(location) in components:
+                by_cell.setdefault(location, []).append(agent)
+
+        return by_cell
+
+    def _match_search(self, sites, by_cell, path_through_fog, max_cost):
+        """Internal - yield (agent, site, cost) from one multi-source search of the sites"""
+
+        if len(by_cell) == 0:
+            return
+
+        fog_filter = None if path_through_fog else lambda cell: cell in by_cell or not self.graph.get_fog(cell)
+
+        for cell, site, cost in Path.dijkstras_multi_source(self.graph, sites, by_cell, fog_filter, max_cost):
+            for agent in by_cell[cell]:
+                yield agent, site, cost
+
+    def match_nearest(self, sites, agents, path_through_fog=False, max_cost=None):
+        """Yields (agent, site, cost) for every agent reachable from any of the sites,
+        nearest first, paired with its nearest site, using one multi-source search.
+        Agents further than max_cost are not found"""
+
+        yield from self._match_search(sites, self._match_cells(sites, agents), path_through_fog, max_cost)
+
+    def path_match(self, sites, agents, on_finish, path_through_fog=False, max_cost=None, args=()):
+        """Matches agents to their nearest sites like match_nearest, but on the path thread,
+        and runs on_finish with any args and a list of (agent, site, cost), nearest first"""
+
+        if args:
+            on_finish = partial(on_finish, *args)
+
+        # agent locations are read here, rather than on the path thread
+        query = (PathMode.Match, sites, self._match_cells(sites, agents), on_finish, path_through_fog, max_cost)
+        self._queue_path(query)
 
     def reveal(self, cell):
         """Removes fog-of-war in a 3x3 pattern around the specified cell,
@@ -311,32 +533,25 @@ class World:
         return discovered
 
     def add_location(self, location, location_type):
-        """Adds a building to the location dictionary"""
-
-        self.buildings[location] = location_type
-
-        for event in self.on_buildings_changed:
-            event(location, location_type)
+        """Adds a building to the building registry"""
+        self.buildings.add(location, location_type)
 
     def get_locations(self, location_type):
         """Gets a list of all buildings of the specified type,
         or None if none were found"""
 
-        locations = []
-        for key in self.buildings:
-            if self.buildings[key] is location_type:
-                locations.append(key)
-
+        locations = self.buildings.of_type(location_type)
         return locations if len(locations) > 0 else None
 
+    def get_nearest_location(self, location_type, cell):
+        """Gets the building of the specified type closest to a cell,
+        or None if none were found"""
+        return self.buildings.nearest(location_type, cell)
+
     def add_resource(self, location, resource, count=1):
         """Adds resources to the specified cell"""
 
-        self.resources[resource][location] += count
-        c = self.resources[resource][location]
-
-        if c == 0:
-            self.resources[resource].pop(location)
+        c = self.resources.add(location, resource, count)
 
         for event in self.on_resources_changed:
             event(location, resource, c)
@@ -345,29 +560,65 @@ class World:
 
     def get_resource(self, location, resource):
         """Gets the number of resources of a specific type at a cell"""
+        return self.resources.get(location, resource)
 
-        if location in self.resources[resource]:
-            return self.resources[resource][location]
-
-        return 0
+    def get_resource_total(self, resource):
+        """Gets the total number of resources of a specific type in the world"""
+        return self.resources.total(resource)
 
     def step_forward(self, step=1):
-        """Move the world forward a step of the specified size, update all agents"""
+        """Move the world forward a step of the specified size, update all awake agents,
+        then advance all walking units together"""
 
         self._time += step
+        self._tick += 1
         self._dispatch_delayed()
+        self._wake_pending()
+
+        # offset ticks by agent id, spreading throttled states evenly over ticks
+        for agent in list(self._active):
+            agent.update(step, self._tick + agent.agent_id)
+
+        self.movement.step(step)
+
+    def sleep(self, agent, duration=None):
+        """Stops updating an agent until it is woken, or the duration has passed"""
+
+        self._active.pop(agent, None)
+
+        handle = self._wake_handles.pop(agent, None)
+        if handle is not None:
+            handle.cancel()
+
+        if duration is not None:
+            self._wake_handles[agent] = self._wakeups.schedule(self._time + duration, agent)
 
-        for agent in self.agents.values():
-            agent.update(step)
+    def wake(self, agent):
+        """Resumes updating an agent from the next step. Safe to call from the path thread"""
+        self._woken.append(agent)
+
+    def subscribe(self, agent_id, message, cell=None):
+        """Subscribe an agent to broadcasts of a message type, optionally only about a cell"""
+        self.bus.subscribe(agent_id, message, cell)
+
+    def unsubscribe(self, agent_id, message=None, cell=None):
+        """Unsubscribe an agent from broadcasts, or from all of them if no message type is provided"""
+        self.bus.unsubscribe(agent_id, message, cell)
+
+    def hears(self, agent_id, telegram) -> bool:
+        """Checks if a subscribed agent should receive a broadcast"""
+        return True
 
     def dispatch(self, telegram: Telegram, delay=0):
-        """Dispatch a message with optional delay"""
+        """Dispatch a message with optional delay.
+        Broadcasts (with no receiver) only reach agents subscribed to them"""
 
         agents = []
 
         if telegram.receiver_id is None:
-            for agent in self.agents.values():
-                if agent.agent_id is not telegram.sender_id:
+            for agent_id in self.bus.subscribers(telegram):
+                agent = self.get_agent(agent_id)
+                if agent is not None and agent_id != telegram.sender_id and self.hears(agent_id, telegram):
                     agents.append(agent)
         else:
             if isinstance(telegram.receiver_id, int):
@@ -378,10 +629,17 @@ class World:
                 agents = self.get_agents(telegram.receiver_id)
 
         if delay <= 0:
+            self.messages_sent += len(agents)
             for agent in agents:
                 agent.handle_message(telegram)
             return len(agents)
 
-        telegram.dispatch_time = self._time + delay
-        self._messages.append(telegram)
+        self.schedule(telegram, delay)
         return 0
+
+    def schedule(self, telegram: Telegram, delay):
+        """Schedule a message for dispatch after a delay,
+        returning a TimerHandle which can be used to cancel it"""
+
+        telegram.dispatch_time = self._time + delay
+        return self._timers.schedule(telegram.dispatch_time, telegram)